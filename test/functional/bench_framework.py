@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 The Dash Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Micro-benchmarks for the python test framework.
+
+This does not start any node. Each suite times a hot path of the framework and
+checks that its result is still correct, then prints the rate in ops/sec.
+
+Run all suites with bench_framework.py, or name the ones to run."""
+
+import argparse
+from io import BytesIO
+import struct
+import sys
+import time
+
+from test_framework.messages import (
+    COIN,
+    COutPoint,
+    CBlock,
+    CBlockHeader,
+    CompressibleBlockHeader,
+    CInv,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    ByteReader,
+    msg_clsig,
+    msg_headers2,
+    msg_inv,
+    msg_isdlock,
+    msg_ping,
+    sha256,
+)
+from test_framework.framing import build_frame, frame_checksum
+from test_framework.p2p import MAGIC_BYTES, P2PConnection
+from test_framework.serialize import (
+    deser_compact_size,
+    deser_uint256,
+    ser_compact_size,
+    ser_uint256,
+    uint256_from_str,
+)
+
+SUITES = {}
+
+
+def suite(name):
+    def register(func):
+        SUITES[name] = func
+        return func
+    return register
+
+
+def timeit(label, func, iterations):
+    """Run func iterations times and print the rate."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    elapsed = time.perf_counter() - start
+    print("  %-32s %12.0f ops/sec" % (label, iterations / elapsed if elapsed else float("inf")))
+
+
+def roundtrip(obj):
+    """Serialize obj, decode it into a new instance and return both encodings."""
+    raw = obj.serialize()
+    decoded = type(obj)()
+    decoded.deserialize(ByteReader(raw))
+    return raw, decoded.serialize()
+
+
+def make_block(num_txs):
+    block = CBlock()
+    block.nBits = 0x207fffff
+    for i in range(num_txs):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(i + 1, 0), b"\x51", 0xffffffff))
+        tx.vout.append(CTxOut(COIN, b"\x76\xa9\x14" + bytes(20) + b"\x88\xac"))
+        block.vtx.append(tx)
+    block.hashMerkleRoot = block.calc_merkle_root()
+    return block
+
+
+# The format-string implementations the serialize module replaced, kept as the
+# baseline for the "primitives" suite.
+def legacy_ser_compact_size(l):
+    if l < 253:
+        return struct.pack("B", l)
+    elif l < 0x10000:
+        return struct.pack("<BH", 253, l)
+    elif l < 0x100000000:
+        return struct.pack("<BI", 254, l)
+    return struct.pack("<BQ", 255, l)
+
+
+def legacy_deser_compact_size(f):
+    nit = struct.unpack("<B", f.read(1))[0]
+    if nit == 253:
+        nit = struct.unpack("<H", f.read(2))[0]
+    elif nit == 254:
+        nit = struct.unpack("<I", f.read(4))[0]
+    elif nit == 255:
+        nit = struct.unpack("<Q", f.read(8))[0]
+    return nit
+
+
+def legacy_ser_uint256(u):
+    rs = b""
+    for _ in range(8):
+        rs += struct.pack("<I", u & 0xFFFFFFFF)
+        u >>= 32
+    return rs
+
+
+def legacy_deser_uint256(f):
+    r = 0
+    for i in range(8):
+        t = struct.unpack("<I", f.read(4))[0]
+        r += t << (i * 32)
+    return r
+
+
+def legacy_uint256_from_str(s):
+    r = 0
+    t = struct.unpack("<IIIIIIII", s[:32])
+    for i in range(8):
+        r += t[i] << (i * 32)
+    return r
+
+
+@suite("primitives")
+def bench_primitives(iterations):
+    """Compare the serialize module primitives against the legacy implementations."""
+    sizes = [1, 200, 300, 70000]
+    value = 0x0123456789abcdef << 150
+    raw = ser_uint256(value)
+    cases = [
+        ("ser_compact_size", lambda: [ser_compact_size(n) for n in sizes],
+         lambda: [legacy_ser_compact_size(n) for n in sizes]),
+        ("deser_compact_size", lambda: [deser_compact_size(BytesIO(ser_compact_size(n))) for n in sizes],
+         lambda: [legacy_deser_compact_size(BytesIO(ser_compact_size(n))) for n in sizes]),
+        ("ser_uint256", lambda: ser_uint256(value), lambda: legacy_ser_uint256(value)),
+        ("deser_uint256", lambda: deser_uint256(BytesIO(raw)), lambda: legacy_deser_uint256(BytesIO(raw))),
+        ("uint256_from_str", lambda: uint256_from_str(raw), lambda: legacy_uint256_from_str(raw)),
+    ]
+    for label, func, legacy in cases:
+        assert func() == legacy(), label
+        timeit(label, func, iterations)
+        timeit(label + " (legacy)", legacy, iterations)
+
+
+class RawMessage:
+    """A message with a fixed payload, to build P2P frames from."""
+    def __init__(self, msgtype, payload):
+        self.msgtype = msgtype
+        self.payload = payload
+
+    def serialize(self):
+        return self.payload
+
+
+class CountingConnection(P2PConnection):
+    """A P2PConnection without a socket that counts the messages it receives."""
+    def __init__(self):
+        super().__init__()
+        self.magic_bytes = MAGIC_BYTES["regtest"]
+        self.dstaddr = "127.0.0.1"
+        self.dstport = 0
+        self._trusted_peer = True
+        self.received = 0
+
+    def on_message(self, message):
+        self.received += 1
+
+
+@suite("recv")
+def bench_recv(iterations):
+    """Stream P2P frames through P2PConnection.data_received() in 64KB chunks."""
+    chunk_size = 64 * 1024
+    cases = [
+        # "spork" frames are checked and then dropped without being decoded,
+        # so these only measure framing.
+        ("200B frames", RawMessage(b"spork", bytes(200)), iterations * 100, True),
+        ("4MB frames", RawMessage(b"spork", bytes(4 * 1024 * 1024)), max(1, iterations // 20), True),
+        ("4MB frames (unverified)", RawMessage(b"spork", bytes(4 * 1024 * 1024)), max(1, iterations // 20), False),
+        ("ping frames", msg_ping(1), iterations * 100, True),
+    ]
+    for label, message, count, verify_checksums in cases:
+        conn = CountingConnection()
+        conn.verify_checksums = verify_checksums
+        frame = conn.build_message(message)
+        stream = frame * count
+        chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+        start = time.perf_counter()
+        for chunk in chunks:
+            conn.data_received(chunk)
+        elapsed = time.perf_counter() - start
+        if not isinstance(message, RawMessage):
+            assert conn.received == count, label
+        assert not conn.recvbuf, label
+        print("  %-32s %12.1f MB/sec (%d MB)" % (label, len(stream) / elapsed / 1e6, len(stream) // 1000000))
+
+
+@suite("framing")
+def bench_framing(iterations):
+    """Compare building frames and checksums against hashing with a new sha256 per call."""
+    payload = bytes(200)
+    magic = MAGIC_BYTES["regtest"]
+    cases = [
+        ("frame_checksum(200B)", lambda: frame_checksum(payload), lambda: sha256(sha256(payload))[:4]),
+        ("build_frame(200B)", lambda: build_frame(magic, b"tx", payload),
+         lambda: magic + b"tx" + bytes(10) + struct.pack("<I", len(payload)) + sha256(sha256(payload))[:4] + payload),
+    ]
+    for label, func, legacy in cases:
+        assert func() == legacy(), label
+        timeit(label, func, iterations * 100)
+        timeit(label + " (legacy)", legacy, iterations * 100)
+
+
+def make_headers(count):
+    """Return a chain of count block headers, with a few distinct versions."""
+    headers = []
+    prev = 0
+    for i in range(count):
+        header = CBlockHeader()
+        header.nVersion = 0x20000000 | (i // 100 % 3)
+        header.hashPrevBlock = prev
+        header.hashMerkleRoot = i
+        header.nTime = 1600000000 + 150 * i
+        header.nBits = 0x207fffff
+        header.nNonce = i
+        prev = header.rehash()
+        headers.append(header)
+    return headers
+
+
+@suite("headers2")
+def bench_headers2(iterations):
+    """Compress and uncompress a batch of 2000 headers, the most a headers2 message holds."""
+    msg = msg_headers2([CompressibleBlockHeader(h) for h in make_headers(2000)])
+    raw = msg.serialize()
+
+    def decode():
+        decoded = msg_headers2()
+        decoded.deserialize(ByteReader(raw))
+        return decoded
+
+    assert [h.sha256 for h in decode().headers] == [h.sha256 for h in msg.headers]
+    count = max(1, iterations // 100)
+    timeit("encode 2000 headers", msg.serialize, count)
+    timeit("decode 2000 headers", decode, count)
+
+
+@suite("codec")
+def bench_codec(iterations):
+    """Round-trip message objects through serialize() and deserialize()."""
+    objects = {
+        "msg_inv(500)": msg_inv([CInv(1, i) for i in range(500)]),
+        "msg_isdlock(10)": msg_isdlock(1, [COutPoint(i, i) for i in range(10)], 1, 2),
+        "msg_clsig": msg_clsig(1, 2),
+        "block(100 txs)": make_block(100),
+    }
+    for label, obj in objects.items():
+        raw, reencoded = roundtrip(obj)
+        assert raw == reencoded, label
+        timeit(label, lambda obj=obj: roundtrip(obj), iterations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("suites", nargs="*", help="suites to run, out of %s (default: all)" % ", ".join(sorted(SUITES)))
+    parser.add_argument("--iterations", type=int, default=1000, help="iterations per benchmark (default: %(default)s)")
+    args = parser.parse_args()
+    unknown = set(args.suites) - set(SUITES)
+    if unknown:
+        parser.error("unknown suites: %s" % ", ".join(sorted(unknown)))
+    for name in args.suites or sorted(SUITES):
+        print("%s:" % name)
+        SUITES[name](args.iterations)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -26,6 +26,7 @@ from test_framework.messages import (
     FromHex,
     hash256,
     ser_string,
+    txs_from_hex,
 )
 from test_framework.script import (
     CScript,
@@ -174,8 +175,7 @@ class AssetLocksTest(DashTestFramework):
         cbb.rehash()
         block = create_block(tip, cbb, block_time, version=4)
         # Add quorum commitments from block template
-        for tx_obj in gbt["transactions"]:
-            tx = FromHex(CTransaction(), tx_obj["data"])
+        for tx in txs_from_hex(tx_obj["data"] for tx_obj in gbt["transactions"]):
             if tx.nType == 6:
                 block.vtx.append(tx)
         for tx in txes:
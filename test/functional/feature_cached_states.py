@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 The Dash Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Test cached DashTestFramework states.
+
+Without --cached, setup_network() and the activations run as usual. With it,
+they are cached steps and are restored from snapshots of earlier runs if
+there are any. Either way the test then saves the state of the nodes as a
+snapshot and restores it, checks that the nodes agree with what they had
+before, and that quorums still form."""
+
+import shutil
+
+from test_framework.snapshot import SnapshotCache
+from test_framework.test_framework import DashTestFramework
+from test_framework.util import assert_equal, softfork_active
+
+
+class CachedStatesTest(DashTestFramework):
+    def add_options(self, parser):
+        parser.add_argument("--cached", dest="cached", default=False, action="store_true",
+                            help="Restore the setup and the activations from cached states")
+
+    def set_test_params(self):
+        self.set_dash_test_params(5, 4, fast_dip3_enforcement=True)
+
+    def setup_network(self):
+        self.use_cached_states = self.options.cached
+        super().setup_network()
+
+    def summary(self):
+        node = self.nodes[0]
+        return {
+            "tips": [n.getbestblockhash() for n in self.nodes],
+            "balances": [n.getbalance() for n in self.nodes],
+            "sporks": node.spork('show'),
+            "masternodes": node.masternodelist("status"),
+            "mninfo": [mninfo.to_json() for mninfo in self.mninfo],
+            "mocktime": self.mocktime,
+        }
+
+    def run_test(self):
+        self.activate_dip8()
+        self.activate_v19(expected_activation_height=900)
+        assert softfork_active(self.nodes[0], 'v19')
+        assert_equal(self.cached_steps is not None, self.options.cached)
+        if self.options.cached:
+            assert_equal([step[0] for step in self.cached_steps], ['setup_network', 'activate_dip8', 'activate_by_name'])
+        expected = self.summary()
+        assert_equal(len(expected["masternodes"]), self.mn_count)
+        assert all(status == 'ENABLED' for status in expected["masternodes"].values())
+
+        self.log.info("Save the state of the nodes and restore it")
+        # The tmpdir makes the key unique, so the state is always built first
+        key = [self.options.tmpdir]
+
+        def build():
+            return [mninfo.to_json() for mninfo in self.mninfo]
+
+        def not_cached():
+            raise AssertionError("State was not cached")
+
+        assert_equal(self.cached_state("roundtrip", build, key), expected["mninfo"])
+        assert_equal(self.summary(), expected)
+        assert_equal(self.cached_state("roundtrip", not_cached, key), expected["mninfo"])
+        assert_equal(self.summary(), expected)
+        shutil.rmtree(SnapshotCache(self.options.cachedir, self.options.bitcoind).path(
+            "roundtrip", [self.chain, self.cached_state_key(), key]))
+
+        self.log.info("Mine a quorum with the restored nodes")
+        self.nodes[0].sporkupdate("SPORK_17_QUORUM_DKG_ENABLED", 0)
+        self.wait_for_sporks_same()
+        self.mine_quorum()
+
+        self.log.info("Steps after a change to the nodes are not cached")
+        self.use_cached_states = True
+        steps_run = []
+        self.cached_step(lambda: steps_run.append('noop'), 'noop')
+        assert_equal(steps_run, ['noop'])
+        assert self.cached_steps is None
+
+
+if __name__ == '__main__':
+    CachedStatesTest().main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 The Dash Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Test the node's inbound connection limit under many concurrent peers.
+
+A swarm of peers connects to the node at once. Below -maxconnections every
+peer completes the handshake. Past it, the node must keep the number of
+inbound peers at its limit, evicting or dropping the rest."""
+
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import assert_equal, assert_greater_than_or_equal
+
+# -maxconnections=30 leaves 30 - 8 full relay - 2 block relay - 1 feeler = 19 inbound slots
+MAX_CONNECTIONS = 30
+MAX_INBOUND = 19
+
+
+class P2PSwarmTest(BitcoinTestFramework):
+    def set_test_params(self):
+        self.setup_clean_chain = True
+        self.num_nodes = 1
+        self.num_network_loops = 4
+        self.extra_args = [["-maxconnections=%d" % MAX_CONNECTIONS]]
+
+    def log_stats(self, swarm):
+        for key, value in swarm.stats().items():
+            self.log.info("  %s: %s" % (key, value))
+
+    def run_test(self):
+        node = self.nodes[0]
+
+        self.log.info("Connect a swarm that fits into the inbound slots")
+        swarm = node.add_p2p_swarm(MAX_INBOUND)
+        stats = swarm.stats()
+        assert_equal(stats["handshaked"], MAX_INBOUND)
+        assert_equal(stats["disconnected"], 0)
+        assert_equal(len(node.getpeerinfo()), MAX_INBOUND)
+
+        self.log.info("Check that every peer is told about a new block")
+        node.generate(1)
+        swarm.wait_for_inv()
+        self.log_stats(swarm)
+        node.disconnect_p2ps()
+
+        self.log.info("Connect a swarm five times the size of the inbound slots")
+        swarm = node.add_p2p_swarm(5 * MAX_INBOUND)
+        self.wait_until(lambda: len(node.getpeerinfo()) == len(swarm.connected_peers()))
+        stats = swarm.stats()
+        self.log_stats(swarm)
+        assert_greater_than_or_equal(MAX_INBOUND, len(node.getpeerinfo()))
+        assert_greater_than_or_equal(stats["disconnected"], 4 * MAX_INBOUND)
+        assert_greater_than_or_equal(stats["connected"], 1)
+
+        self.log.info("Check that the remaining peers are still served")
+        node.generate(1)
+        swarm.wait_for_inv()
+        node.disconnect_p2ps()
+        assert_equal(len(node.getpeerinfo()), 0)
+
+
+if __name__ == '__main__':
+    P2PSwarmTest().main()
@@ -20,6 +20,7 @@ from .messages import (
     CTxIn,
     CTxOut,
     FromHex,
+    txs_from_hex,
     uint256_to_string,
 )
 from .script import CScript, CScriptNum, CScriptOp, OP_TRUE, OP_CHECKSIG
@@ -144,10 +145,9 @@ def create_block_with_mnpayments(mninfo, node, vtx=None, mn_payee=None, mn_amoun
     block.vtx += vtx
 
     # Add quorum commitments from template
-    for tx in bt['transactions']:
-        tx2 = FromHex(CTransaction(), tx['data'])
-        if tx2.nType == 6:
-            block.vtx.append(tx2)
+    for tx in txs_from_hex(t['data'] for t in bt['transactions']):
+        if tx.nType == 6:
+            block.vtx.append(tx)
 
     block.hashMerkleRoot = block.calc_merkle_root()
     block.solve()
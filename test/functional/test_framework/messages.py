@@ -17,15 +17,36 @@ Classes use __slots__ to ensure extraneous attributes aren't accidentally added
 by tests, compromising their intended effect.
 """
 
+from bisect import bisect_left
 import copy
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 import hashlib
 from io import BytesIO
 import random
+import pickle
 import socket
 import struct
 import time
-
+import unittest
+
+from test_framework.serialize import (
+    INT16,
+    INT32,
+    INT64,
+    UINT8,
+    UINT16,
+    UINT32,
+    ByteReader,
+    deser_compact_size,
+    deser_string,
+    deser_struct,
+    deser_uint256,
+    ser_compact_size,
+    ser_string,
+    ser_string_into,
+    ser_uint256,
+    uint256_from_str,
+)
 from test_framework.siphash import siphash256
 from test_framework.util import hex_str_to_bytes, assert_equal
 
@@ -75,57 +96,11 @@ def hash256(s):
 def dashhash(s):
     return dash_hash.getPoWHash(s)
 
-def ser_compact_size(l):
-    r = b""
-    if l < 253:
-        r = struct.pack("B", l)
-    elif l < 0x10000:
-        r = struct.pack("<BH", 253, l)
-    elif l < 0x100000000:
-        r = struct.pack("<BI", 254, l)
-    else:
-        r = struct.pack("<BQ", 255, l)
-    return r
-
-def deser_compact_size(f):
-    nit = struct.unpack("<B", f.read(1))[0]
-    if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
-    elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
-    elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
-    return nit
-
-def deser_string(f):
-    nit = deser_compact_size(f)
-    return f.read(nit)
-
-def ser_string(s):
-    return ser_compact_size(len(s)) + s
-
-def deser_uint256(f):
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
-
-
-def ser_uint256(u):
-    rs = b""
-    for _ in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
-
-
-def uint256_from_str(s):
-    r = 0
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in range(8):
-        r += t[i] << (i * 32)
-    return r
+_BLOCK_HEADER = struct.Struct("<i32s32sIII")
+_SERVICE = struct.Struct(">16sH")
+_SMLE_KEYS = struct.Struct("<48s20s?")
+_QC_PREFIX = struct.Struct("<HB")
+_QC_SIGS = struct.Struct("<96s96s")
 
 
 def uint256_to_string(uint256):
@@ -156,13 +131,26 @@ def deser_vector(f, c, deser_function_name=None):
 # ser_function_name: Allow for an alternate serialization function on the
 # entries in the vector (we use this for serializing addrv2 messages).
 def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
+    r = bytearray()
+    ser_vector_into(r, l, ser_function_name)
+    return bytes(r)
+
+
+# Append the serialized vector to the bytearray r. Entries that provide
+# serialize_into() write straight into r instead of returning a new bytes
+# object, so nested vectors (e.g. a block's transactions) are built in a
+# single buffer.
+def ser_vector_into(r, l, ser_function_name=None):
+    r += ser_compact_size(len(l))
     for i in l:
         if ser_function_name:
             r += getattr(i, ser_function_name)()
         else:
-            r += i.serialize()
-    return r
+            serialize_into = getattr(i, "serialize_into", None)
+            if serialize_into is not None:
+                serialize_into(r)
+            else:
+                r += i.serialize()
 
 
 def deser_uint256_vector(f):
@@ -175,10 +163,88 @@ def deser_uint256_vector(f):
 
 
 def ser_uint256_vector(l):
-    r = ser_compact_size(len(l))
+    r = bytearray(ser_compact_size(len(l)))
     for i in l:
         r += ser_uint256(i)
-    return r
+    return bytes(r)
+
+
+class DynBitSet:
+    """A dynamically sized bitset, stored as an int with bit i at position i.
+
+    Behaves like the list of bools it replaces: it supports len(), indexing,
+    iteration, count(), append(), extend() and comparison with lists.
+    to_list() converts it on demand."""
+    __slots__ = ("size", "value")
+
+    def __init__(self, bools=None):
+        self.size = 0
+        self.value = 0
+        if bools is not None:
+            bools = list(bools)
+            self.size = len(bools)
+            for i, b in enumerate(bools):
+                if b:
+                    self.value |= 1 << i
+
+    def __len__(self):
+        return self.size
+
+    def _index(self, i):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError("DynBitSet index out of range")
+        return i
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.to_list()[i]
+        return (self.value >> self._index(i)) & 1 == 1
+
+    def __setitem__(self, i, b):
+        i = self._index(i)
+        if b:
+            self.value |= 1 << i
+        else:
+            self.value &= ~(1 << i)
+
+    def __iter__(self):
+        n = self.size
+        for byte_idx, byte in enumerate(self.value.to_bytes((n + 7) // 8, "little")):
+            for bit in range(min(8, n - byte_idx * 8)):
+                yield (byte >> bit) & 1 == 1
+
+    def __eq__(self, other):
+        if isinstance(other, DynBitSet):
+            return self.size == other.size and self.value == other.value
+        if isinstance(other, (list, tuple)):
+            return self.to_list() == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def count(self, b):
+        """Return the number of bits equal to b, like list.count()."""
+        if b == 1:
+            return bin(self.value).count("1")
+        if b == 0:
+            return self.size - bin(self.value).count("1")
+        return 0
+
+    def append(self, b):
+        self.size += 1
+        self[-1] = b
+
+    def extend(self, bools):
+        for b in bools:
+            self.append(b)
+
+    def to_list(self):
+        return list(self)
+
+    def __repr__(self):
+        return "DynBitSet(%s)" % "".join("1" if b else "0" for b in self)
 
 
 def deser_dyn_bitset(f, bytes_based):
@@ -187,36 +253,193 @@ def deser_dyn_bitset(f, bytes_based):
         n = nb * 8
     else:
         n = deser_compact_size(f)
-        nb = int((n + 7) / 8)
+        nb = (n + 7) // 8
     b = f.read(nb)
-    r = []
-    for i in range(n):
-        r.append((b[int(i / 8)] & (1 << (i % 8))) != 0)
+    if len(b) != nb:
+        raise struct.error("unpack requires a buffer of %d bytes" % nb)
+    r = DynBitSet()
+    r.size = n
+    r.value = int.from_bytes(b, "little") & ((1 << n) - 1)
     return r
 
 
 def ser_dyn_bitset(l, bytes_based):
-    n = len(l)
-    nb = int((n + 7) / 8)
-    r = [0] * nb
-    for i in range(n):
-        r[int(i / 8)] |= (1 if l[i] else 0) << (i % 8)
+    if not isinstance(l, DynBitSet):
+        l = DynBitSet(l)
+    n = l.size
+    nb = (n + 7) // 8
     if bytes_based:
-        r = ser_compact_size(nb) + bytes(r)
+        r = ser_compact_size(nb)
     else:
-        r = ser_compact_size(n) + bytes(r)
-    return r
+        r = ser_compact_size(n)
+    return r + (l.value & ((1 << n) - 1)).to_bytes(nb, "little")
 
 
 # Deserialize from a hex string representation (eg from RPC)
 def FromHex(obj, hex_string):
-    obj.deserialize(BytesIO(hex_str_to_bytes(hex_string)))
+    obj.deserialize(ByteReader(hex_str_to_bytes(hex_string)))
     return obj
 
+# Deserialize a list of hex strings (eg from RPC) into objects of class c.
+# All strings are decoded into one shared buffer, which each object is then
+# read from in turn.
+def objs_from_hex(c, hex_strings):
+    hex_strings = list(hex_strings)
+    f = ByteReader(bytes.fromhex("".join(hex_strings)))
+    r = []
+    end = 0
+    for hex_string in hex_strings:
+        end += len(hex_string) // 2
+        obj = c()
+        obj.deserialize(f)
+        if f.tell() != end:
+            raise ValueError("%s hex string does not match its serialization: %s" % (c.__name__, hex_string))
+        r.append(obj)
+    return r
+
+def txs_from_hex(hex_strings):
+    return objs_from_hex(CTransaction, hex_strings)
+
+# Build a CBlock from the output of getblock with verbosity 2, which includes
+# the hex of every transaction, without fetching the raw block again.
+def block_from_rpc_verbose(block_json):
+    block = CBlock()
+    block.nVersion = block_json["version"]
+    block.hashPrevBlock = int(block_json.get("previousblockhash", "0"), 16)
+    block.hashMerkleRoot = int(block_json["merkleroot"], 16)
+    block.nTime = block_json["time"]
+    block.nBits = int(block_json["bits"], 16)
+    block.nNonce = block_json["nonce"]
+    block.vtx = txs_from_hex(tx["hex"] for tx in block_json["tx"])
+    return block
+
 # Convert a binary-serializable object to hex (eg for submission via RPC)
 def ToHex(obj):
     return obj.serialize().hex()
 
+
+# Declarative field specs
+#
+# Classes with a fixed field layout list their fields as (name, spec) pairs in
+# FIELDS and are decorated with @compile_codec, which generates deserialize(),
+# serialize() and serialize_into() once per class. Runs of consecutive
+# fixed-width fields are decoded with a single precompiled struct.Struct.
+class FieldSpec:
+    """How to (de)serialize one field.
+
+    Fixed-width fields have a struct format code in fmt, and optionally decode
+    (raw value -> field) and encode (field -> raw value) converters. A "Ns"
+    field without encode is a raw byte string, which serialize_into() appends
+    as-is. Variable-width fields provide deser(f) and ser_into(r, value)."""
+    __slots__ = ("fmt", "decode", "encode", "deser", "ser_into")
+
+    def __init__(self, fmt=None, *, decode=None, encode=None, deser=None, ser_into=None):
+        self.fmt = fmt
+        self.decode = decode
+        self.encode = encode
+        self.deser = deser
+        self.ser_into = ser_into
+
+
+def _ser_compact_size_into(r, l):
+    r += ser_compact_size(l)
+
+
+def _ser_uint256_vector_into(r, l):
+    r += ser_uint256_vector(l)
+
+
+uint8 = FieldSpec("B")
+uint16 = FieldSpec("H")
+int32 = FieldSpec("i")
+uint32 = FieldSpec("I")
+int64 = FieldSpec("q")
+uint64 = FieldSpec("Q")
+boolean = FieldSpec("?")
+uint256 = FieldSpec("32s", decode=lambda b: int.from_bytes(b, "little"), encode=ser_uint256)
+compact_size = FieldSpec(deser=deser_compact_size, ser_into=_ser_compact_size_into)
+var_bytes = FieldSpec(deser=deser_string, ser_into=ser_string_into)
+uint256_vector = FieldSpec(deser=deser_uint256_vector, ser_into=_ser_uint256_vector_into)
+
+
+def fixed_bytes(n):
+    return FieldSpec("%ds" % n)
+
+
+def compact_vector(c):
+    return FieldSpec(deser=lambda f: deser_vector(f, c), ser_into=ser_vector_into)
+
+
+def compile_codec(cls):
+    """Class decorator generating the codec methods of cls from cls.FIELDS."""
+    env = {"deser_struct": deser_struct}
+    de_lines = []
+    ser_lines = []
+    de_run = []
+    ser_run = []
+
+    def flush_de_run():
+        if not de_run:
+            return
+        st = "_st%d" % len(env)
+        env[st] = struct.Struct("<" + "".join(spec.fmt for _, spec in de_run))
+        values = ["_v%d" % i for i in range(len(de_run))]
+        de_lines.append("    %s, = deser_struct(f, %s)" % (", ".join(values), st))
+        for value, (name, spec) in zip(values, de_run):
+            if spec.decode is None:
+                de_lines.append("    self.%s = %s" % (name, value))
+            else:
+                env["_dec_" + name] = spec.decode
+                de_lines.append("    self.%s = _dec_%s(%s)" % (name, name, value))
+        de_run.clear()
+
+    def flush_ser_run():
+        if not ser_run:
+            return
+        st = "_st%d" % len(env)
+        env[st] = struct.Struct("<" + "".join(spec.fmt for _, spec in ser_run))
+        args = []
+        for name, spec in ser_run:
+            if spec.encode is None:
+                args.append("self.%s" % name)
+            else:
+                env["_enc_" + name] = spec.encode
+                args.append("_enc_%s(self.%s)" % (name, name))
+        ser_lines.append("    r += %s.pack(%s)" % (st, ", ".join(args)))
+        ser_run.clear()
+
+    for name, spec in cls.FIELDS:
+        if spec.fmt is not None:
+            de_run.append((name, spec))
+            if spec.fmt.endswith("s") and spec.encode is None:
+                # Raw bytes are appended unchanged, even if their length is off
+                flush_ser_run()
+                ser_lines.append("    r += self.%s" % name)
+            else:
+                ser_run.append((name, spec))
+        else:
+            flush_de_run()
+            flush_ser_run()
+            env["_deser_" + name] = spec.deser
+            env["_ser_" + name] = spec.ser_into
+            de_lines.append("    self.%s = _deser_%s(f)" % (name, name))
+            ser_lines.append("    _ser_%s(r, self.%s)" % (name, name))
+    flush_de_run()
+    flush_ser_run()
+
+    source = "\n".join(
+        ["def deserialize(self, f):"] + (de_lines or ["    pass"]) +
+        ["def serialize_into(self, r):"] + (ser_lines or ["    pass"]) +
+        ["def serialize(self):",
+         "    r = bytearray()",
+         "    self.serialize_into(r)",
+         "    return bytes(r)"])
+    exec(compile(source, "<codec %s>" % cls.__name__, "exec"), env)
+    for method in ("deserialize", "serialize_into", "serialize"):
+        env[method].__qualname__ = "%s.%s" % (cls.__name__, method)
+        setattr(cls, method, env[method])
+    return cls
+
 # Objects that map to dashd objects, which can be serialized/deserialized
 
 class CService:
@@ -227,8 +450,8 @@ class CService:
         self.port = 0
 
     def deserialize(self, f):
-        self.ip = socket.inet_ntop(socket.AF_INET6, f.read(16))
-        self.port = struct.unpack(">H", f.read(2))[0]
+        ip, self.port = deser_struct(f, _SERVICE)
+        self.ip = socket.inet_ntop(socket.AF_INET6, ip)
 
     def serialize(self):
         r = b""
@@ -319,8 +542,13 @@ class CAddress:
                 % (self.nServices, self.ADDRV2_NET_NAME[self.net], self.ip, self.port))
 
 
+@compile_codec
 class CInv:
     __slots__ = ("hash", "type")
+    FIELDS = (
+        ("type", uint32),
+        ("hash", uint256),
+    )
 
     typemap = {
         0: "Error",
@@ -334,16 +562,6 @@ class CInv:
         self.type = t
         self.hash = h
 
-    def deserialize(self, f):
-        self.type = struct.unpack("<I", f.read(4))[0]
-        self.hash = deser_uint256(f)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<I", self.type)
-        r += ser_uint256(self.hash)
-        return r
-
     def __repr__(self):
         return "CInv(type=%s hash=%064x)" \
                % (self.typemap.get(self.type, "%d" % self.type), self.hash)
@@ -374,23 +592,18 @@ class CBlockLocator:
                % (self.nVersion, repr(self.vHave))
 
 
+@compile_codec
 class COutPoint:
     __slots__ = ("hash", "n")
+    FIELDS = (
+        ("hash", uint256),
+        ("n", uint32),
+    )
 
     def __init__(self, hash=0, n=0xFFFFFFFF):
         self.hash = hash
         self.n = n
 
-    def deserialize(self, f):
-        self.hash = deser_uint256(f)
-        self.n = struct.unpack("<I", f.read(4))[0]
-
-    def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
-
     def __repr__(self):
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
 
@@ -410,14 +623,17 @@ class CTxIn:
         self.prevout = COutPoint()
         self.prevout.deserialize(f)
         self.scriptSig = deser_string(f)
-        self.nSequence = struct.unpack("<I", f.read(4))[0]
+        self.nSequence = deser_struct(f, UINT32)[0]
 
     def serialize(self):
-        r = b""
-        r += self.prevout.serialize()
-        r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
-        return r
+        r = bytearray()
+        self.serialize_into(r)
+        return bytes(r)
+
+    def serialize_into(self, r):
+        self.prevout.serialize_into(r)
+        ser_string_into(r, self.scriptSig)
+        r += UINT32.pack(self.nSequence)
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i)" \
@@ -425,33 +641,46 @@ class CTxIn:
                   self.nSequence)
 
 
+@compile_codec
 class CTxOut:
     __slots__ = ("nValue", "scriptPubKey")
+    FIELDS = (
+        ("nValue", int64),
+        ("scriptPubKey", var_bytes),
+    )
 
     def __init__(self, nValue=0, scriptPubKey=b""):
         self.nValue = nValue
         self.scriptPubKey = scriptPubKey
 
-    def deserialize(self, f):
-        self.nValue = struct.unpack("<q", f.read(8))[0]
-        self.scriptPubKey = deser_string(f)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<q", self.nValue)
-        r += ser_string(self.scriptPubKey)
-        return r
-
     def __repr__(self):
         return "CTxOut(nValue=%i.%08i scriptPubKey=%s)" \
                % (self.nValue // COIN, self.nValue % COIN,
                   self.scriptPubKey.hex())
 
 
+def _set_slots_state(obj, state):
+    """__setstate__ for classes that drop cached hashes in __setattr__.
+
+    copy and pickle restore the slots one at a time, so assigning them
+    through __setattr__ would drop hashes that were already restored."""
+    if isinstance(state, tuple):
+        state = state[1]
+    for name, value in (state or {}).items():
+        object.__setattr__(obj, name, value)
+
+
 class CTransaction:
+    """A transaction.
+
+    sha256 and hash are computed on demand and cached. Assigning one of the
+    serialized fields drops the cached hashes; mutating the contents of vin or
+    vout in place is not tracked and needs an explicit rehash()."""
     __slots__ = ("hash", "nLockTime", "nVersion", "sha256", "vin", "vout",
                  "nType", "vExtraPayload")
 
+    _HASHED_FIELDS = frozenset(("nLockTime", "nVersion", "vin", "vout", "nType", "vExtraPayload"))
+
     def __init__(self, tx=None):
         if tx is None:
             self.nVersion = 1
@@ -472,28 +701,56 @@ class CTransaction:
             self.sha256 = tx.sha256
             self.hash = tx.hash
 
-    def deserialize(self, f):
-        ver32bit = struct.unpack("<i", f.read(4))[0]
+    def clone(self):
+        """Return a copy that shares its inputs and outputs with this one.
+
+        vin and vout are new lists, but their entries are the same CTxIn and
+        CTxOut objects. Replace an entry rather than mutating it to leave the
+        original transaction unchanged; CTransaction(tx) makes a deep copy."""
+        tx = CTransaction.__new__(CTransaction)
+        tx.nVersion = self.nVersion
+        tx.nType = self.nType
+        tx.vin = list(self.vin)
+        tx.vout = list(self.vout)
+        tx.nLockTime = self.nLockTime
+        tx.vExtraPayload = self.vExtraPayload
+        tx.sha256 = self.sha256
+        tx.hash = self.hash
+        return tx
+
+    def deserialize(self, f):
+        ver32bit = deser_struct(f, INT32)[0]
         self.nVersion = ver32bit & 0xffff
         self.nType = (ver32bit >> 16) & 0xffff
         self.vin = deser_vector(f, CTxIn)
         self.vout = deser_vector(f, CTxOut)
-        self.nLockTime = struct.unpack("<I", f.read(4))[0]
+        self.nLockTime = deser_struct(f, UINT32)[0]
         if self.nType != 0:
             self.vExtraPayload = deser_string(f)
         self.sha256 = None
         self.hash = None
 
     def serialize(self):
-        r = b""
+        r = bytearray()
+        self.serialize_into(r)
+        return bytes(r)
+
+    def serialize_into(self, r):
         ver32bit = int(self.nVersion | (self.nType << 16))
-        r += struct.pack("<i", ver32bit)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
+        r += INT32.pack(ver32bit)
+        ser_vector_into(r, self.vin)
+        ser_vector_into(r, self.vout)
+        r += UINT32.pack(self.nLockTime)
         if self.nType != 0:
-            r += ser_string(self.vExtraPayload)
-        return r
+            ser_string_into(r, self.vExtraPayload)
+
+    def __setattr__(self, name, value):
+        if name in self._HASHED_FIELDS:
+            object.__setattr__(self, "sha256", None)
+            object.__setattr__(self, "hash", None)
+        object.__setattr__(self, name, value)
+
+    __setstate__ = _set_slots_state
 
     def rehash(self):
         self.sha256 = None
@@ -502,8 +759,9 @@ class CTransaction:
 
     def calc_sha256(self):
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize()))
-        self.hash = hash256(self.serialize())[::-1].hex()
+            h = hash256(self.serialize())
+            self.sha256 = uint256_from_str(h)
+            self.hash = h[::-1].hex()
 
     def is_valid(self):
         self.calc_sha256()
@@ -523,9 +781,15 @@ class CTransaction:
 
 
 class CBlockHeader:
+    """A block header.
+
+    sha256 and hash are computed on demand and cached until one of the header
+    fields is assigned."""
     __slots__ = ("hash", "hashMerkleRoot", "hashPrevBlock", "nBits", "nNonce",
                  "nTime", "nVersion", "sha256")
 
+    _HASHED_FIELDS = frozenset(("hashMerkleRoot", "hashPrevBlock", "nBits", "nNonce", "nTime", "nVersion"))
+
     def __init__(self, header=None):
         if header is None:
             self.set_null()
@@ -551,36 +815,38 @@ class CBlockHeader:
         self.hash = None
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.hashPrevBlock = deser_uint256(f)
-        self.hashMerkleRoot = deser_uint256(f)
-        self.nTime = struct.unpack("<I", f.read(4))[0]
-        self.nBits = struct.unpack("<I", f.read(4))[0]
-        self.nNonce = struct.unpack("<I", f.read(4))[0]
+        (self.nVersion, hashPrevBlock, hashMerkleRoot,
+         self.nTime, self.nBits, self.nNonce) = deser_struct(f, _BLOCK_HEADER)
+        self.hashPrevBlock = int.from_bytes(hashPrevBlock, "little")
+        self.hashMerkleRoot = int.from_bytes(hashMerkleRoot, "little")
         self.sha256 = None
         self.hash = None
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.nBits)
-        r += struct.pack("<I", self.nNonce)
-        return r
+        return self.serialize_header()
+
+    def serialize_into(self, r):
+        r += self.serialize_header()
+
+    def serialize_header(self):
+        """Serialize only the 80 byte header, also for CBlock objects."""
+        return _BLOCK_HEADER.pack(self.nVersion, ser_uint256(self.hashPrevBlock),
+                                  ser_uint256(self.hashMerkleRoot), self.nTime,
+                                  self.nBits, self.nNonce)
+
+    def __setattr__(self, name, value):
+        if name in self._HASHED_FIELDS:
+            object.__setattr__(self, "sha256", None)
+            object.__setattr__(self, "hash", None)
+        object.__setattr__(self, name, value)
+
+    __setstate__ = _set_slots_state
 
     def calc_sha256(self):
         if self.sha256 is None:
-            r = b""
-            r += struct.pack("<i", self.nVersion)
-            r += ser_uint256(self.hashPrevBlock)
-            r += ser_uint256(self.hashMerkleRoot)
-            r += struct.pack("<I", self.nTime)
-            r += struct.pack("<I", self.nBits)
-            r += struct.pack("<I", self.nNonce)
-            self.sha256 = uint256_from_str(dashhash(r))
-            self.hash = dashhash(r)[::-1].hex()
+            h = dashhash(self.serialize_header())
+            self.sha256 = uint256_from_str(h)
+            self.hash = h[::-1].hex()
 
     def rehash(self):
         self.sha256 = None
@@ -595,22 +861,95 @@ class CBlockHeader:
 BLOCK_HEADER_SIZE = len(CBlockHeader().serialize())
 assert_equal(BLOCK_HEADER_SIZE, 80)
 
+class MerkleTree:
+    """A merkle tree over 32 byte leaf hashes that keeps all interior nodes.
+
+    levels[0] holds the leaves and levels[-1] the root. Appending or replacing
+    leaves only rehashes the nodes on the paths from the changed leaves to the
+    root. As in dashd, the last node of a level with an odd number of nodes is
+    paired with itself."""
+    __slots__ = ("levels",)
+
+    def __init__(self, hashes=None):
+        self.levels = [[]]
+        if hashes:
+            self.update(hashes)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def root(self):
+        if not self.levels[0]:
+            return 0
+        return uint256_from_str(self.levels[-1][0])
+
+    def append(self, h):
+        self.levels[0].append(h)
+        self._propagate([len(self.levels[0]) - 1])
+
+    def replace(self, index, h):
+        self.levels[0][index] = h
+        self._propagate([index])
+
+    def update(self, hashes):
+        """Make the leaves equal to hashes, rehashing only what changed."""
+        leaves = self.levels[0]
+        old_len = len(leaves)
+        dirty = [i for i in range(min(old_len, len(hashes))) if leaves[i] != hashes[i]]
+        for i in dirty:
+            leaves[i] = hashes[i]
+        if len(hashes) < old_len:
+            del leaves[len(hashes):]
+            # The new last leaf may now be paired with itself
+            dirty.append(len(hashes) - 1)
+        elif len(hashes) > old_len:
+            leaves.extend(hashes[old_len:])
+            dirty.extend(range(old_len, len(hashes)))
+        if dirty:
+            self._propagate(dirty)
+
+    def _propagate(self, dirty):
+        levels = self.levels
+        level = 0
+        while len(levels[level]) > 1:
+            nodes = levels[level]
+            if level + 1 == len(levels):
+                levels.append([])
+            parents = levels[level + 1]
+            parents_len = (len(nodes) + 1) // 2
+            del parents[parents_len:]
+            parents.extend([None] * (parents_len - len(parents)))
+            dirty = sorted({i >> 1 for i in dirty})
+            for p in dirty:
+                left = nodes[2 * p]
+                right = nodes[2 * p + 1] if 2 * p + 1 < len(nodes) else left
+                parents[p] = hash256(left + right)
+            level += 1
+        del levels[level + 1:]
+
+
 class CBlock(CBlockHeader):
-    __slots__ = ("vtx",)
+    __slots__ = ("vtx", "merkle_tree")
 
     def __init__(self, header=None):
         super().__init__(header)
         self.vtx = []
+        # Merkle tree of the last calc_merkle_root() call, reused to only
+        # rehash the paths of transactions that changed since.
+        self.merkle_tree = None
 
     def deserialize(self, f):
         super().deserialize(f)
         self.vtx = deser_vector(f, CTransaction)
 
     def serialize(self):
-        r = b""
-        r += super().serialize()
-        r += ser_vector(self.vtx)
-        return r
+        r = bytearray()
+        self.serialize_into(r)
+        return bytes(r)
+
+    def serialize_into(self, r):
+        r += self.serialize_header()
+        ser_vector_into(r, self.vtx)
 
     # Calculate the merkle root given a vector of transaction hashes
     @staticmethod
@@ -628,7 +967,11 @@ class CBlock(CBlockHeader):
         for tx in self.vtx:
             tx.calc_sha256()
             hashes.append(ser_uint256(tx.sha256))
-        return self.get_merkle_root(hashes)
+        if self.merkle_tree is None:
+            self.merkle_tree = MerkleTree(hashes)
+        else:
+            self.merkle_tree.update(hashes)
+        return self.merkle_tree.root()
 
     def is_valid(self):
         self.calc_sha256()
@@ -655,6 +998,49 @@ class CBlock(CBlockHeader):
                   time.ctime(self.nTime), self.nBits, self.nNonce, repr(self.vtx))
 
 
+class LazyBlock(CBlock):
+    """A CBlock that only deserializes its transactions on first access of vtx.
+
+    The header is decoded eagerly; the serialized transactions are kept as raw
+    bytes until needed and are written back unchanged by serialize()."""
+    __slots__ = ("_vtx_data",)
+
+    def __init__(self, header=None):
+        self._vtx_data = None
+        super().__init__(header)
+
+    @property
+    def vtx(self):
+        if self._vtx_data is not None:
+            data = self._vtx_data
+            self._vtx_data = None
+            CBlock.vtx.__set__(self, deser_vector(ByteReader(data), CTransaction))
+        return CBlock.vtx.__get__(self)
+
+    @vtx.setter
+    def vtx(self, value):
+        self._vtx_data = None
+        CBlock.vtx.__set__(self, value)
+
+    def deserialize(self, f):
+        CBlockHeader.deserialize(self, f)
+        self._vtx_data = f.read()
+
+    def serialize_into(self, r):
+        if self._vtx_data is None:
+            super().serialize_into(r)
+        else:
+            r += self.serialize_header()
+            r += self._vtx_data
+
+    def __repr__(self):
+        if self._vtx_data is None:
+            return super().__repr__()
+        return "LazyBlock(nVersion=%i hashPrevBlock=%064x hashMerkleRoot=%064x nTime=%s nBits=%08x nNonce=%08x vtx=<%d bytes>)" \
+               % (self.nVersion, self.hashPrevBlock, self.hashMerkleRoot,
+                  time.ctime(self.nTime), self.nBits, self.nNonce, len(self._vtx_data))
+
+
 class CompressibleBlockHeader:
     __slots__ = ("bitfield", "timeOffset", "nVersion", "hashPrevBlock", "hashMerkleRoot", "nTime", "nBits", "nNonce",
                  "hash", "sha256")
@@ -667,6 +1053,7 @@ class CompressibleBlockHeader:
     FLAG_NBITS = 1 << 5
 
     BITMASK_VERSION = FLAG_VERSION_BIT_0 | FLAG_VERSION_BIT_1 | FLAG_VERSION_BIT_2
+    BITMASK_UNCOMPRESSED = FLAG_PREV_BLOCK_HASH | FLAG_TIMESTAMP | FLAG_NBITS
 
     def __init__(self, header=None):
         if header is None:
@@ -680,8 +1067,8 @@ class CompressibleBlockHeader:
             self.nTime = header.nTime
             self.nBits = header.nBits
             self.nNonce = header.nNonce
-            self.hash = None
-            self.sha256 = None
+            # Don't hash the header again if it already was
+            self.hash = self.sha256 = header.sha256
             self.calc_sha256()
 
     def set_null(self):
@@ -697,46 +1084,44 @@ class CompressibleBlockHeader:
         self.sha256 = None
 
     def deserialize(self, f):
-        self.bitfield = struct.unpack("<B", f.read(1))[0]
+        self.bitfield = deser_struct(f, UINT8)[0]
         if self.bitfield & self.BITMASK_VERSION == 0:
-            self.nVersion = struct.unpack("<i", f.read(4))[0]
+            self.nVersion = deser_struct(f, INT32)[0]
         if self.bitfield & self.FLAG_PREV_BLOCK_HASH:
             self.hashPrevBlock = deser_uint256(f)
         self.hashMerkleRoot = deser_uint256(f)
         if self.bitfield & self.FLAG_TIMESTAMP:
-            self.nTime = struct.unpack("<I", f.read(4))[0]
+            self.nTime = deser_struct(f, UINT32)[0]
         else:
-            self.timeOffset = struct.unpack("<h", f.read(2))[0]
+            self.timeOffset = deser_struct(f, INT16)[0]
         if self.bitfield & self.FLAG_NBITS:
-            self.nBits = struct.unpack("<I", f.read(4))[0]
-        self.nNonce = struct.unpack("<I", f.read(4))[0]
-        self.rehash()
+            self.nBits = deser_struct(f, UINT32)[0]
+        self.nNonce = deser_struct(f, UINT32)[0]
+        self.hash = None
+        self.sha256 = None
+        # A compressed header is only hashed once it is uncompressed
+        if self.bitfield & self.BITMASK_UNCOMPRESSED == self.BITMASK_UNCOMPRESSED and not self.bitfield & self.BITMASK_VERSION:
+            self.calc_sha256()
 
     def serialize(self):
         r = b""
-        r += struct.pack("<B", self.bitfield)
+        r += UINT8.pack(self.bitfield)
         if not self.bitfield & self.BITMASK_VERSION:
-            r += struct.pack("<i", self.nVersion)
+            r += INT32.pack(self.nVersion)
         if self.bitfield & self.FLAG_PREV_BLOCK_HASH:
             r += ser_uint256(self.hashPrevBlock)
         r += ser_uint256(self.hashMerkleRoot)
-        r += struct.pack("<I", self.nTime) if self.bitfield & self.FLAG_TIMESTAMP else struct.pack("<h", self.timeOffset)
+        r += UINT32.pack(self.nTime) if self.bitfield & self.FLAG_TIMESTAMP else INT16.pack(self.timeOffset)
         if self.bitfield & self.FLAG_NBITS:
-            r += struct.pack("<I", self.nBits)
-        r += struct.pack("<I", self.nNonce)
+            r += UINT32.pack(self.nBits)
+        r += UINT32.pack(self.nNonce)
         return r
 
     def calc_sha256(self):
         if self.sha256 is None:
-            r = b""
-            r += struct.pack("<i", self.nVersion)
-            r += ser_uint256(self.hashPrevBlock)
-            r += ser_uint256(self.hashMerkleRoot)
-            r += struct.pack("<I", self.nTime)
-            r += struct.pack("<I", self.nBits)
-            r += struct.pack("<I", self.nNonce)
-            self.sha256 = uint256_from_str(dashhash(r))
-            self.hash = int(dashhash(r)[::-1].hex(), 16)
+            r = _BLOCK_HEADER.pack(self.nVersion, ser_uint256(self.hashPrevBlock), ser_uint256(self.hashMerkleRoot),
+                                   self.nTime, self.nBits, self.nNonce)
+            self.sha256 = self.hash = uint256_from_str(dashhash(r))
 
     def rehash(self):
         self.sha256 = None
@@ -748,81 +1133,96 @@ class CompressibleBlockHeader:
                "nBits=%08x nNonce=%08x timeOffset=%i)" % \
                (self.bitfield, self.nVersion, self.hashPrevBlock, self.hashMerkleRoot, time.ctime(self.nTime), self.nBits, self.nNonce, self.timeOffset)
 
-    def __save_version_as_most_recent(self, last_unique_versions):
-        last_unique_versions.insert(0, self.nVersion)
 
-        # Evict the oldest version
-        if len(last_unique_versions) > 7:
-            last_unique_versions.pop()
+class HeadersCompressionState:
+    """The state headers2 compression carries from one header to the next.
 
-    @staticmethod
-    def __mark_version_as_most_recent(last_unique_versions, version_idx):
-        # Move version to the front of the list
-        last_unique_versions.insert(0, last_unique_versions.pop(version_idx))
-
-    def compress(self, last_blocks, last_unique_versions):
-        if not last_blocks:
-            # First block, everything must be uncompressed
-            self.bitfield &= (~CompressibleBlockHeader.BITMASK_VERSION)
-            self.bitfield |= CompressibleBlockHeader.FLAG_PREV_BLOCK_HASH
-            self.bitfield |= CompressibleBlockHeader.FLAG_TIMESTAMP
-            self.bitfield |= CompressibleBlockHeader.FLAG_NBITS
-            self.__save_version_as_most_recent(last_unique_versions)
-            return
+    This is the previous header and an LRU cache of the last
+    MAX_UNIQUE_VERSIONS distinct block versions, which compressed headers
+    refer to by their offset from the most recently used one. The cache is an
+    OrderedDict, from least to most recently used, so looking up, refreshing
+    and evicting a version never moves the other entries.
 
-        # Compress version
-        try:
-            version_idx = last_unique_versions.index(self.nVersion)
-            version_offset = len(last_unique_versions) - version_idx
-            self.bitfield &= (~CompressibleBlockHeader.BITMASK_VERSION)
-            self.bitfield |= (version_offset & CompressibleBlockHeader.BITMASK_VERSION)
-            self.__mark_version_as_most_recent(last_unique_versions, version_idx)
-        except ValueError:
-            self.__save_version_as_most_recent(last_unique_versions)
-
-        # We have the previous block
-        last_block = last_blocks[-1]
-
-        # Compress time
-        self.timeOffset = self.nTime - last_block.nTime
-        if self.timeOffset > 32767 or self.timeOffset < -32768:
-            # Time diff overflows, we have to send it as 4 bytes (uncompressed)
-            self.bitfield |= CompressibleBlockHeader.FLAG_TIMESTAMP
+    compress() and uncompress() process one header at a time, so a long
+    chain can be streamed through a state. The node starts from a fresh state
+    for every headers2 message, which msg_headers2 does as well."""
+    __slots__ = ("previous", "versions")
 
-        # If nBits doesn't match previous block, we have to send it
-        if self.nBits != last_block.nBits:
-            self.bitfield |= CompressibleBlockHeader.FLAG_NBITS
+    MAX_UNIQUE_VERSIONS = 7
 
-    def uncompress(self, last_compressed_blocks, last_unique_versions):
-        if not last_compressed_blocks:
-            # First block header is always uncompressed
-            self.__save_version_as_most_recent(last_unique_versions)
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.previous = None
+        self.versions = OrderedDict()
+
+    def _use_version(self, version):
+        """Mark version as the most recently used one.
+
+        Returns the offset it had, or 0 if it was not cached."""
+        versions = self.versions
+        if version not in versions:
+            versions[version] = None
+            if len(versions) > self.MAX_UNIQUE_VERSIONS:
+                versions.popitem(last=False)
+            return 0
+        offset = 1
+        for cached in reversed(versions):
+            if cached == version:
+                break
+            offset += 1
+        versions.move_to_end(version)
+        return offset
+
+    def _version_at(self, offset):
+        """Return the version at offset and mark it as the most recently used one."""
+        for version in reversed(self.versions):
+            offset -= 1
+            if not offset:
+                break
+        self.versions.move_to_end(version)
+        return version
+
+    def compress(self, header):
+        """Set the bitfield and time offset of the CompressibleBlockHeader that follows the previous one."""
+        previous = self.previous
+        self.previous = header
+        if previous is None:
+            # First header, everything must be uncompressed
+            self._use_version(header.nVersion)
+            header.bitfield = CompressibleBlockHeader.BITMASK_UNCOMPRESSED
             return
-
-        previous_block = last_compressed_blocks[-1]
-
-        # Uncompress version
-        version_idx = self.bitfield & self.BITMASK_VERSION
-        if version_idx != 0:
-            if version_idx <= len(last_unique_versions):
-                self.nVersion = last_unique_versions[version_idx - 1]
-                self.__mark_version_as_most_recent(last_unique_versions, version_idx - 1)
+        bitfield = self._use_version(header.nVersion)
+        header.timeOffset = header.nTime - previous.nTime
+        if header.timeOffset > 32767 or header.timeOffset < -32768:
+            # Time diff overflows, we have to send it as 4 bytes (uncompressed)
+            bitfield |= CompressibleBlockHeader.FLAG_TIMESTAMP
+        # If nBits doesn't match previous block, we have to send it
+        if header.nBits != previous.nBits:
+            bitfield |= CompressibleBlockHeader.FLAG_NBITS
+        header.bitfield = bitfield
+
+    def uncompress(self, header):
+        """Fill in the fields the deserialized CompressibleBlockHeader leaves out and hash it."""
+        previous = self.previous
+        self.previous = header
+        bitfield = header.bitfield
+        version_offset = bitfield & CompressibleBlockHeader.BITMASK_VERSION
+        if previous is None or not version_offset:
+            self._use_version(header.nVersion)
+        elif version_offset <= len(self.versions):
+            header.nVersion = self._version_at(version_offset)
+        if previous is not None:
+            if not bitfield & CompressibleBlockHeader.FLAG_PREV_BLOCK_HASH:
+                header.hashPrevBlock = previous.sha256
+            if not bitfield & CompressibleBlockHeader.FLAG_TIMESTAMP:
+                header.nTime = previous.nTime + header.timeOffset
+            if not bitfield & CompressibleBlockHeader.FLAG_NBITS:
+                header.nBits = previous.nBits
+            header.rehash()
         else:
-            self.__save_version_as_most_recent(last_unique_versions)
-
-        # Uncompress prev block hash
-        if not self.bitfield & self.FLAG_PREV_BLOCK_HASH:
-            self.hashPrevBlock = previous_block.hash
-
-        # Uncompress time
-        if not self.bitfield & self.FLAG_TIMESTAMP:
-            self.nTime = previous_block.nTime + self.timeOffset
-
-        # Uncompress time bits
-        if not self.bitfield & self.FLAG_NBITS:
-            self.nBits = previous_block.nBits
-
-        self.rehash()
+            header.calc_sha256()
 
 
 class PrefilledTransaction:
@@ -992,23 +1392,18 @@ class BlockTransactionsRequest:
         return "BlockTransactionsRequest(hash=%064x indexes=%s)" % (self.blockhash, repr(self.indexes))
 
 
+@compile_codec
 class BlockTransactions:
     __slots__ = ("blockhash", "transactions")
+    FIELDS = (
+        ("blockhash", uint256),
+        ("transactions", compact_vector(CTransaction)),
+    )
 
     def __init__(self, blockhash=0, transactions = None):
         self.blockhash = blockhash
         self.transactions = transactions if transactions is not None else []
 
-    def deserialize(self, f):
-        self.blockhash = deser_uint256(f)
-        self.transactions = deser_vector(f, CTransaction)
-
-    def serialize(self):
-        r = b""
-        r += ser_uint256(self.blockhash)
-        r += ser_vector(self.transactions)
-        return r
-
     def __repr__(self):
         return "BlockTransactions(hash=%064x transactions=%s)" % (self.blockhash, repr(self.transactions))
 
@@ -1033,6 +1428,52 @@ class CPartialMerkleTree:
         r += ser_dyn_bitset(self.vBits, True)
         return r
 
+    def initialize_from_tree(self, tree, matches):
+        """Build the partial tree proving the leaves of the MerkleTree tree at the indexes in matches."""
+        self.nTransactions = len(tree)
+        self.vBits = []
+        self.vHash = []
+        matches = sorted(set(matches))
+
+        def traverse_and_build(height, pos):
+            first = bisect_left(matches, pos << height)
+            parent_of_match = first < len(matches) and matches[first] < min((pos + 1) << height, self.nTransactions)
+            self.vBits.append(parent_of_match)
+            if height == 0 or not parent_of_match:
+                self.vHash.append(uint256_from_str(tree.levels[height][pos]))
+            else:
+                traverse_and_build(height - 1, pos * 2)
+                if pos * 2 + 1 < len(tree.levels[height - 1]):
+                    traverse_and_build(height - 1, pos * 2 + 1)
+
+        if self.nTransactions:
+            traverse_and_build(len(tree.levels) - 1, 0)
+
+    def extract_matches(self):
+        """Return the merkle root and a dict of matched leaf index to hash."""
+        bits = iter(self.vBits)
+        hashes = iter(self.vHash)
+        matches = {}
+        height = 0
+        while (self.nTransactions + (1 << height) - 1) >> height > 1:
+            height += 1
+
+        def traverse_and_extract(height, pos):
+            parent_of_match = next(bits)
+            if height == 0 or not parent_of_match:
+                h = next(hashes)
+                if height == 0 and parent_of_match:
+                    matches[pos] = h
+                return ser_uint256(h)
+            left = traverse_and_extract(height - 1, pos * 2)
+            if pos * 2 + 1 < (self.nTransactions + (1 << (height - 1)) - 1) >> (height - 1):
+                right = traverse_and_extract(height - 1, pos * 2 + 1)
+            else:
+                right = left
+            return hash256(left + right)
+
+        return uint256_from_str(traverse_and_extract(height, 0)), matches
+
     def __repr__(self):
         return "CPartialMerkleTree(nTransactions=%d vBits.size=%d vHash.size=%d)" % (self.nTransactions, len(self.vBits), len(self.vHash))
 
@@ -1054,6 +1495,13 @@ class CMerkleBlock:
         r += self.txn.serialize()
         return r
 
+    def initialize_from_block(self, block, txids):
+        """Build a merkleblock proving the transactions of block whose sha256 is in txids."""
+        block.calc_merkle_root()
+        self.header = CBlockHeader(block)
+        self.txn = CPartialMerkleTree()
+        self.txn.initialize_from_tree(block.merkle_tree, [i for i, tx in enumerate(block.vtx) if tx.sha256 in txids])
+
     def __repr__(self):
         return "CMerkleBlock(header=%s txn=%s)" % (repr(self.header), repr(self.txn))
 
@@ -1087,15 +1535,15 @@ class CCbTx:
         self.lockedAmount = 0
 
     def deserialize(self, f):
-        self.version = struct.unpack("<H", f.read(2))[0]
-        self.height = struct.unpack("<i", f.read(4))[0]
+        self.version = deser_struct(f, UINT16)[0]
+        self.height = deser_struct(f, INT32)[0]
         self.merkleRootMNList = deser_uint256(f)
         if self.version >= 2:
             self.merkleRootQuorums = deser_uint256(f)
             if self.version >= 3:
                 self.bestCLHeightDiff = deser_compact_size(f)
                 self.bestCLSignature = f.read(96)
-                self.lockedAmount = struct.unpack("<q", f.read(8))[0]
+                self.lockedAmount = deser_struct(f, INT64)[0]
 
 
     def serialize(self):
@@ -1112,8 +1560,13 @@ class CCbTx:
         return r
 
 
+@compile_codec
 class CAssetLockTx:
     __slots__ = ("version", "creditOutputs")
+    FIELDS = (
+        ("version", uint8),
+        ("creditOutputs", compact_vector(CTxOut)),
+    )
 
     def __init__(self, version=None, creditOutputs=None):
         self.set_null()
@@ -1125,23 +1578,22 @@ class CAssetLockTx:
         self.version = 0
         self.creditOutputs = None
 
-    def deserialize(self, f):
-        self.version = struct.unpack("<B", f.read(1))[0]
-        self.creditOutputs = deser_vector(f, CTxOut)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.version)
-        r += ser_vector(self.creditOutputs)
-        return r
-
     def __repr__(self):
         return "CAssetLockTx(version={} creditOutputs={}" \
             .format(self.version, repr(self.creditOutputs))
 
 
+@compile_codec
 class CAssetUnlockTx:
     __slots__ = ("version", "index", "fee", "requestedHeight", "quorumHash", "quorumSig")
+    FIELDS = (
+        ("version", uint8),
+        ("index", uint64),
+        ("fee", uint32),
+        ("requestedHeight", uint32),
+        ("quorumHash", uint256),
+        ("quorumSig", fixed_bytes(96)),
+    )
 
     def __init__(self, version=None, index=None, fee=None, requestedHeight=None, quorumHash = 0, quorumSig = None):
         self.set_null()
@@ -1166,31 +1618,20 @@ class CAssetUnlockTx:
         self.quorumHash = 0
         self.quorumSig = b'\x00' * 96
 
-    def deserialize(self, f):
-        self.version = struct.unpack("<B", f.read(1))[0]
-        self.index = struct.unpack("<Q", f.read(8))[0]
-        self.fee = struct.unpack("<I", f.read(4))[0]
-        self.requestedHeight = struct.unpack("<I", f.read(4))[0]
-        self.quorumHash = deser_uint256(f)
-        self.quorumSig = f.read(96)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.version)
-        r += struct.pack("<Q", self.index)
-        r += struct.pack("<I", self.fee)
-        r += struct.pack("<I", self.requestedHeight)
-        r += ser_uint256(self.quorumHash)
-        r += self.quorumSig
-        return r
-
     def __repr__(self):
         return "CAssetUnlockTx(version={} index={} fee={} requestedHeight={} quorumHash={:x} quorumSig={}" \
             .format(self.version, self.index, self.fee, self.requestedHeight, self.quorumHash, self.quorumSig.hex())
 
 
+@compile_codec
 class CMnEhf:
     __slots__ = ("version", "versionBit", "quorumHash", "quorumSig")
+    FIELDS = (
+        ("version", uint8),
+        ("versionBit", uint8),
+        ("quorumHash", uint256),
+        ("quorumSig", fixed_bytes(96)),
+    )
 
     def __init__(self, version=None, versionBit=None, quorumHash = 0, quorumSig = None):
         self.set_null()
@@ -1209,20 +1650,6 @@ class CMnEhf:
         self.quorumHash = 0
         self.quorumSig = b'\x00' * 96
 
-    def deserialize(self, f):
-        self.version = struct.unpack("<B", f.read(1))[0]
-        self.versionBit = struct.unpack("<B", f.read(1))[0]
-        self.quorumHash = deser_uint256(f)
-        self.quorumSig = f.read(96)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.version)
-        r += struct.pack("<B", self.versionBit)
-        r += ser_uint256(self.quorumHash)
-        r += self.quorumSig
-        return r
-
     def __repr__(self):
         return "CMnEhf(version={} versionBit={} quorumHash={:x} quorumSig={}" \
             .format(self.version, self.versionBit, self.quorumHash, self.quorumSig.hex())
@@ -1247,17 +1674,15 @@ class CSimplifiedMNListEntry:
         self.platformNodeID = b'\x00' * 20
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<H", f.read(2))[0]
+        self.nVersion = deser_struct(f, UINT16)[0]
         self.proRegTxHash = deser_uint256(f)
         self.confirmedHash = deser_uint256(f)
         self.service.deserialize(f)
-        self.pubKeyOperator = f.read(48)
-        self.keyIDVoting = f.read(20)
-        self.isValid = struct.unpack("<?", f.read(1))[0]
+        self.pubKeyOperator, self.keyIDVoting, self.isValid = deser_struct(f, _SMLE_KEYS)
         if self.nVersion == 2:
-            self.type = struct.unpack("<H", f.read(2))[0]
+            self.type = deser_struct(f, UINT16)[0]
             if self.type == 1:
-                self.platformHTTPPort = struct.unpack("<H", f.read(2))[0]
+                self.platformHTTPPort = deser_struct(f, UINT16)[0]
                 self.platformNodeID = f.read(20)
 
     def serialize(self, with_version = True):
@@ -1298,17 +1723,15 @@ class CFinalCommitment:
         self.membersSig = b'\x00' * 96
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<H", f.read(2))[0]
-        self.llmqType = struct.unpack("<B", f.read(1))[0]
+        self.nVersion, self.llmqType = deser_struct(f, _QC_PREFIX)
         self.quorumHash = deser_uint256(f)
         if self.nVersion == 2 or self.nVersion == 4:
-            self.quorumIndex = struct.unpack("<H", f.read(2))[0]
+            self.quorumIndex = deser_struct(f, UINT16)[0]
         self.signers = deser_dyn_bitset(f, False)
         self.validMembers = deser_dyn_bitset(f, False)
         self.quorumPublicKey = f.read(48)
         self.quorumVvecHash = deser_uint256(f)
-        self.quorumSig = f.read(96)
-        self.membersSig = f.read(96)
+        self.quorumSig, self.membersSig = deser_struct(f, _QC_SIGS)
 
     def serialize(self):
         r = b""
@@ -1407,8 +1830,16 @@ class CGovernanceVote:
         return r
 
 
+@compile_codec
 class CRecoveredSig:
     __slots__ = ("llmqType", "quorumHash", "id", "msgHash", "sig")
+    FIELDS = (
+        ("llmqType", uint8),
+        ("quorumHash", uint256),
+        ("id", uint256),
+        ("msgHash", uint256),
+        ("sig", fixed_bytes(96)),
+    )
 
     def __init__(self):
         self.llmqType = 0
@@ -1417,25 +1848,18 @@ class CRecoveredSig:
         self.msgHash = 0
         self.sig = b'\x00' * 96
 
-    def deserialize(self, f):
-        self.llmqType = struct.unpack("<B", f.read(1))[0]
-        self.quorumHash = deser_uint256(f)
-        self.id = deser_uint256(f)
-        self.msgHash = deser_uint256(f)
-        self.sig = f.read(96)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.llmqType)
-        r += ser_uint256(self.quorumHash)
-        r += ser_uint256(self.id)
-        r += ser_uint256(self.msgHash)
-        r += self.sig
-        return r
-
 
+@compile_codec
 class CSigShare:
     __slots__ = ("llmqType", "quorumHash", "quorumMember", "id", "msgHash", "sigShare")
+    FIELDS = (
+        ("llmqType", uint8),
+        ("quorumHash", uint256),
+        ("quorumMember", uint16),
+        ("id", uint256),
+        ("msgHash", uint256),
+        ("sigShare", fixed_bytes(96)),
+    )
 
     def __init__(self):
         self.llmqType = 0
@@ -1445,63 +1869,32 @@ class CSigShare:
         self.msgHash = 0
         self.sigShare = b'\x00' * 96
 
-    def deserialize(self, f):
-        self.llmqType = struct.unpack("<B", f.read(1))[0]
-        self.quorumHash = deser_uint256(f)
-        self.quorumMember = struct.unpack("<H", f.read(2))[0]
-        self.id = deser_uint256(f)
-        self.msgHash = deser_uint256(f)
-        self.sigShare = f.read(96)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.llmqType)
-        r += ser_uint256(self.quorumHash)
-        r += struct.pack("<H", self.quorumMember)
-        r += ser_uint256(self.id)
-        r += ser_uint256(self.msgHash)
-        r += self.sigShare
-        return r
-
 
+@compile_codec
 class CBLSPublicKey:
     __slots__ = ("data")
+    FIELDS = (
+        ("data", fixed_bytes(48)),
+    )
 
     def __init__(self):
         self.data = b'\x00' * 48
 
-    def deserialize(self, f):
-        self.data = f.read(48)
-
-    def serialize(self):
-        r = b""
-        r += self.data
-        return r
-
 
+@compile_codec
 class CBLSIESEncryptedSecretKey:
     __slots__ = ("ephemeral_pubKey", "iv", "data")
+    FIELDS = (
+        ("ephemeral_pubKey", fixed_bytes(48)),
+        ("iv", fixed_bytes(32)),
+        ("data", var_bytes),
+    )
 
     def __init__(self):
         self.ephemeral_pubKey = b'\x00' * 48
         self.iv = b'\x00' * 32
         self.data = b'\x00' * 32
 
-    def deserialize(self, f):
-        self.ephemeral_pubKey = f.read(48)
-        self.iv = f.read(32)
-        data_size = deser_compact_size(f)
-        self.data = f.read(data_size)
-
-    def serialize(self):
-        r = b""
-        r += self.ephemeral_pubKey
-        r += self.iv
-        r += ser_compact_size(len(self.data))
-        r += self.data
-        return r
-
-
 # Objects that correspond to messages on the wire
 class msg_version:
     __slots__ = ("addrFrom", "addrTo", "nNonce", "nRelay", "nServices",
@@ -1630,9 +2023,13 @@ class msg_sendaddrv2:
         return "msg_sendaddrv2()"
 
 
+@compile_codec
 class msg_inv:
     __slots__ = ("inv",)
     msgtype = b"inv"
+    FIELDS = (
+        ("inv", compact_vector(CInv)),
+    )
 
     def __init__(self, inv=None):
         if inv is None:
@@ -1640,29 +2037,21 @@ class msg_inv:
         else:
             self.inv = inv
 
-    def deserialize(self, f):
-        self.inv = deser_vector(f, CInv)
-
-    def serialize(self):
-        return ser_vector(self.inv)
-
     def __repr__(self):
         return "msg_inv(inv=%s)" % (repr(self.inv))
 
 
+@compile_codec
 class msg_getdata:
     __slots__ = ("inv",)
     msgtype = b"getdata"
+    FIELDS = (
+        ("inv", compact_vector(CInv)),
+    )
 
     def __init__(self, inv=None):
         self.inv = inv if inv is not None else []
 
-    def deserialize(self, f):
-        self.inv = deser_vector(f, CInv)
-
-    def serialize(self):
-        return ser_vector(self.inv)
-
     def __repr__(self):
         return "msg_getdata(inv=%s)" % (repr(self.inv))
 
@@ -1718,7 +2107,9 @@ class msg_block:
         else:
             self.block = block
 
-    def deserialize(self, f):
+    def deserialize(self, f, *, lazy=False):
+        if lazy:
+            self.block = LazyBlock()
         self.block.deserialize(f)
 
     def serialize(self):
@@ -1760,40 +2151,32 @@ class msg_getaddr:
         return "msg_getaddr()"
 
 
+@compile_codec
 class msg_ping:
     __slots__ = ("nonce",)
     msgtype = b"ping"
+    FIELDS = (
+        ("nonce", uint64),
+    )
 
     def __init__(self, nonce=0):
         self.nonce = nonce
 
-    def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
-
     def __repr__(self):
         return "msg_ping(nonce=%08x)" % self.nonce
 
 
+@compile_codec
 class msg_pong:
     __slots__ = ("nonce",)
     msgtype = b"pong"
+    FIELDS = (
+        ("nonce", uint64),
+    )
 
     def __init__(self, nonce=0):
         self.nonce = nonce
 
-    def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
-
     def __repr__(self):
         return "msg_pong(nonce=%08x)" % self.nonce
 
@@ -1814,19 +2197,17 @@ class msg_mempool:
     def __repr__(self):
         return "msg_mempool()"
 
+@compile_codec
 class msg_notfound:
     __slots__ = ("vec", )
     msgtype = b"notfound"
+    FIELDS = (
+        ("vec", compact_vector(CInv)),
+    )
 
     def __init__(self, vec=None):
         self.vec = vec or []
 
-    def deserialize(self, f):
-        self.vec = deser_vector(f, CInv)
-
-    def serialize(self):
-        return ser_vector(self.vec)
-
     def __repr__(self):
         return "msg_notfound(vec=%s)" % (repr(self.vec))
 
@@ -1928,14 +2309,22 @@ class msg_headers:
         self.headers = headers if headers is not None else []
 
     def deserialize(self, f):
-        # comment in dashd indicates these should be deserialized as blocks
-        blocks = deser_vector(f, CBlock)
-        for x in blocks:
-            self.headers.append(CBlockHeader(x))
+        # comment in dashd indicates these should be deserialized as blocks,
+        # i.e. each header is followed by an (empty) transaction count
+        for _ in range(deser_compact_size(f)):
+            header = CBlockHeader()
+            header.deserialize(f)
+            deser_vector(f, CTransaction)
+            header.calc_sha256()
+            self.headers.append(header)
 
     def serialize(self):
-        blocks = [CBlock(x) for x in self.headers]
-        return ser_vector(blocks)
+        # serialized as blocks without transactions
+        r = bytearray(ser_compact_size(len(self.headers)))
+        for header in self.headers:
+            r += header.serialize_header()
+            r += b"\x00"
+        return bytes(r)
 
     def __repr__(self):
         return "msg_headers(headers=%s)" % repr(self.headers)
@@ -1952,14 +2341,14 @@ class msg_headers2:
 
     def deserialize(self, f):
         self.headers = deser_vector(f, CompressibleBlockHeader)
-        last_unique_versions = []
-        for idx in range(len(self.headers)):
-            self.headers[idx].uncompress(self.headers[:idx], last_unique_versions)
+        state = HeadersCompressionState()
+        for header in self.headers:
+            state.uncompress(header)
 
     def serialize(self):
-        last_unique_versions = []
-        for idx in range(len(self.headers)):
-            self.headers[idx].compress(self.headers[:idx], last_unique_versions)
+        state = HeadersCompressionState()
+        for header in self.headers:
+            state.compress(header)
         return ser_vector(self.headers)
 
     def __repr__(self):
@@ -1985,9 +2374,16 @@ class msg_merkleblock:
         return "msg_merkleblock(merkleblock=%s)" % (repr(self.merkleblock))
 
 
+@compile_codec
 class msg_filterload:
     __slots__ = ("data", "nHashFuncs", "nTweak", "nFlags")
     msgtype = b"filterload"
+    FIELDS = (
+        ("data", var_bytes),
+        ("nHashFuncs", uint32),
+        ("nTweak", uint32),
+        ("nFlags", uint8),
+    )
 
     def __init__(self, data=b'00', nHashFuncs=0, nTweak=0, nFlags=0):
         self.data = data
@@ -1995,40 +2391,22 @@ class msg_filterload:
         self.nTweak = nTweak
         self.nFlags = nFlags
 
-    def deserialize(self, f):
-        self.data = deser_string(f)
-        self.nHashFuncs = struct.unpack("<I", f.read(4))[0]
-        self.nTweak = struct.unpack("<I", f.read(4))[0]
-        self.nFlags = struct.unpack("<B", f.read(1))[0]
-
-    def serialize(self):
-        r = b""
-        r += ser_string(self.data)
-        r += struct.pack("<I", self.nHashFuncs)
-        r += struct.pack("<I", self.nTweak)
-        r += struct.pack("<B", self.nFlags)
-        return r
-
     def __repr__(self):
         return "msg_filterload(data={}, nHashFuncs={}, nTweak={}, nFlags={})".format(
             self.data, self.nHashFuncs, self.nTweak, self.nFlags)
 
 
+@compile_codec
 class msg_filteradd:
     __slots__ = ("data")
     msgtype = b"filteradd"
+    FIELDS = (
+        ("data", var_bytes),
+    )
 
     def __init__(self, data):
         self.data = data
 
-    def deserialize(self, f):
-        self.data = deser_string(f)
-
-    def serialize(self):
-        r = b""
-        r += ser_string(self.data)
-        return r
-
     def __repr__(self):
         return "msg_filteradd(data={})".format(self.data)
 
@@ -2050,24 +2428,19 @@ class msg_filterclear:
         return "msg_filterclear()"
 
 
+@compile_codec
 class msg_sendcmpct:
     __slots__ = ("announce", "version")
     msgtype = b"sendcmpct"
+    FIELDS = (
+        ("announce", boolean),
+        ("version", uint64),
+    )
 
     def __init__(self, announce=False, version=1):
         self.announce = announce
         self.version = version
 
-    def deserialize(self, f):
-        self.announce = struct.unpack("<?", f.read(1))[0]
-        self.version = struct.unpack("<Q", f.read(8))[0]
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<?", self.announce)
-        r += struct.pack("<Q", self.version)
-        return r
-
     def __repr__(self):
         return "msg_sendcmpct(announce=%s, version=%lu)" % (self.announce, self.version)
 
@@ -2131,34 +2504,51 @@ class msg_blocktxn:
         return "msg_blocktxn(block_transactions=%s)" % (repr(self.block_transactions))
 
 
+@compile_codec
 class msg_getmnlistd:
     __slots__ = ("baseBlockHash", "blockHash",)
     msgtype = b"getmnlistd"
+    FIELDS = (
+        ("baseBlockHash", uint256),
+        ("blockHash", uint256),
+    )
 
     def __init__(self, baseBlockHash=0, blockHash=0):
         self.baseBlockHash = baseBlockHash
         self.blockHash = blockHash
 
-    def deserialize(self, f):
-        self.baseBlockHash = deser_uint256(f)
-        self.blockHash = deser_uint256(f)
-
-    def serialize(self):
-        r = b""
-        r += ser_uint256(self.baseBlockHash)
-        r += ser_uint256(self.blockHash)
-        return r
-
     def __repr__(self):
         return "msg_getmnlistd(baseBlockHash=%064x, blockHash=%064x)" % (self.baseBlockHash, self.blockHash)
 
 QuorumId = namedtuple('QuorumId', ['llmqType', 'quorumHash'])
 
+def _lazy_mnlistdiff_field(name):
+    slot = "_" + name
+
+    def getter(self):
+        self._decode_lazy_data()
+        return getattr(self, slot)
+
+    def setter(self, value):
+        self._decode_lazy_data()
+        setattr(self, slot, value)
+
+    return property(getter, setter)
+
+
 class msg_mnlistdiff:
-    __slots__ = ("baseBlockHash", "blockHash", "merkleProof", "cbTx", "nVersion", "deletedMNs", "mnList", "deletedQuorums", "newQuorums", "quorumsCLSigs")
+    __slots__ = ("baseBlockHash", "blockHash", "merkleProof", "cbTx", "nVersion", "deletedMNs", "_mnList", "_deletedQuorums",
+                 "_newQuorums", "_quorumsCLSigs", "_lazy_data")
     msgtype = b"mnlistdiff"
 
+    # Everything after deletedMNs is only decoded on first access when deserialized lazily
+    mnList = _lazy_mnlistdiff_field("mnList")
+    deletedQuorums = _lazy_mnlistdiff_field("deletedQuorums")
+    newQuorums = _lazy_mnlistdiff_field("newQuorums")
+    quorumsCLSigs = _lazy_mnlistdiff_field("quorumsCLSigs")
+
     def __init__(self):
+        self._lazy_data = None
         self.baseBlockHash = 0
         self.blockHash = 0
         self.merkleProof = CPartialMerkleTree()
@@ -2170,9 +2560,14 @@ class msg_mnlistdiff:
         self.newQuorums = []
         self.quorumsCLSigs = {}
 
+    def _decode_lazy_data(self):
+        if self._lazy_data is not None:
+            data = self._lazy_data
+            self._lazy_data = None
+            self._deserialize_lists(ByteReader(data))
 
-    def deserialize(self, f):
-        self.nVersion = struct.unpack("<H", f.read(2))[0]
+    def deserialize(self, f, *, lazy=False):
+        self.nVersion = deser_struct(f, UINT16)[0]
         self.baseBlockHash = deser_uint256(f)
         self.blockHash = deser_uint256(f)
         self.merkleProof.deserialize(f)
@@ -2180,6 +2575,13 @@ class msg_mnlistdiff:
         self.cbTx.deserialize(f)
         self.cbTx.rehash()
         self.deletedMNs = deser_uint256_vector(f)
+        if lazy:
+            self._lazy_data = f.read()
+        else:
+            self._lazy_data = None
+            self._deserialize_lists(f)
+
+    def _deserialize_lists(self, f):
         self.mnList = []
         for _ in range(deser_compact_size(f)):
             e = CSimplifiedMNListEntry()
@@ -2188,7 +2590,7 @@ class msg_mnlistdiff:
 
         self.deletedQuorums = []
         for _ in range(deser_compact_size(f)):
-            llmqType = struct.unpack("<B", f.read(1))[0]
+            llmqType = deser_struct(f, UINT8)[0]
             quorumHash = deser_uint256(f)
             self.deletedQuorums.append(QuorumId(llmqType, quorumHash))
         self.newQuorums = []
@@ -2201,7 +2603,7 @@ class msg_mnlistdiff:
             signature = f.read(96)
             idx_set = set()
             for _ in range(deser_compact_size(f)):
-                set_element = struct.unpack('H', f.read(2))[0]
+                set_element = deser_struct(f, UINT16)[0]
                 idx_set.add(set_element)
             self.quorumsCLSigs[signature] = idx_set
 
@@ -2209,34 +2611,36 @@ class msg_mnlistdiff:
         return "msg_mnlistdiff(baseBlockHash=%064x, blockHash=%064x)" % (self.baseBlockHash, self.blockHash)
 
 
+@compile_codec
 class msg_clsig:
     __slots__ = ("height", "blockHash", "sig",)
     msgtype = b"clsig"
+    FIELDS = (
+        ("height", int32),
+        ("blockHash", uint256),
+        ("sig", fixed_bytes(96)),
+    )
 
     def __init__(self, height=0, blockHash=0, sig=b'\x00' * 96):
         self.height = height
         self.blockHash = blockHash
         self.sig = sig
 
-    def deserialize(self, f):
-        self.height = struct.unpack('<i', f.read(4))[0]
-        self.blockHash = deser_uint256(f)
-        self.sig = f.read(96)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack('<i', self.height)
-        r += ser_uint256(self.blockHash)
-        r += self.sig
-        return r
-
     def __repr__(self):
         return "msg_clsig(height=%d, blockHash=%064x)" % (self.height, self.blockHash)
 
 
+@compile_codec
 class msg_isdlock:
     __slots__ = ("nVersion", "inputs", "txid", "cycleHash", "sig")
     msgtype = b"isdlock"
+    FIELDS = (
+        ("nVersion", uint8),
+        ("inputs", compact_vector(COutPoint)),
+        ("txid", uint256),
+        ("cycleHash", uint256),
+        ("sig", fixed_bytes(96)),
+    )
 
     def __init__(self, nVersion=1, inputs=None, txid=0, cycleHash=0, sig=b'\x00' * 96):
         self.nVersion = nVersion
@@ -2245,42 +2649,22 @@ class msg_isdlock:
         self.cycleHash = cycleHash
         self.sig = sig
 
-    def deserialize(self, f):
-        self.nVersion = struct.unpack("<B", f.read(1))[0]
-        self.inputs = deser_vector(f, COutPoint)
-        self.txid = deser_uint256(f)
-        self.cycleHash = deser_uint256(f)
-        self.sig = f.read(96)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.nVersion)
-        r += ser_vector(self.inputs)
-        r += ser_uint256(self.txid)
-        r += ser_uint256(self.cycleHash)
-        r += self.sig
-        return r
-
     def __repr__(self):
         return "msg_isdlock(nVersion=%d, inputs=%s, txid=%064x, cycleHash=%064x)" % \
                (self.nVersion, repr(self.inputs), self.txid, self.cycleHash)
 
 
+@compile_codec
 class msg_qsigshare:
     __slots__ = ("sig_shares",)
     msgtype = b"qsigshare"
+    FIELDS = (
+        ("sig_shares", compact_vector(CSigShare)),
+    )
 
     def __init__(self, sig_shares=None):
         self.sig_shares = sig_shares if sig_shares is not None else []
 
-    def deserialize(self, f):
-        self.sig_shares = deser_vector(f, CSigShare)
-
-    def serialize(self):
-        r = b""
-        r += ser_vector(self.sig_shares)
-        return r
-
     def __repr__(self):
         return "msg_qsigshare(sigShares=%d)" % (len(self.sig_shares))
 
@@ -2302,9 +2686,16 @@ class msg_qwatch:
         return "msg_qwatch()"
 
 
+@compile_codec
 class msg_qgetdata:
     __slots__ = ("quorum_hash", "quorum_type", "data_mask", "protx_hash")
     msgtype = b"qgetdata"
+    FIELDS = (
+        ("quorum_type", uint8),
+        ("quorum_hash", uint256),
+        ("data_mask", uint16),
+        ("protx_hash", uint256),
+    )
 
     def __init__(self, quorum_hash=0, quorum_type=-1, data_mask=0, protx_hash=0):
         self.quorum_hash = quorum_hash
@@ -2312,20 +2703,6 @@ class msg_qgetdata:
         self.data_mask = data_mask
         self.protx_hash = protx_hash
 
-    def deserialize(self, f):
-        self.quorum_type = struct.unpack("<B", f.read(1))[0]
-        self.quorum_hash = deser_uint256(f)
-        self.data_mask = struct.unpack("<H", f.read(2))[0]
-        self.protx_hash = deser_uint256(f)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.quorum_type)
-        r += ser_uint256(self.quorum_hash)
-        r += struct.pack("<H", self.data_mask)
-        r += ser_uint256(self.protx_hash)
-        return r
-
     def __repr__(self):
         return "msg_qgetdata(quorum_hash=%064x, quorum_type=%d, data_mask=%d, protx_hash=%064x)" % (
                                                                                 self.quorum_hash,
@@ -2377,84 +2754,73 @@ class msg_qdata:
         return "msg_qdata(error=%d, quorum_vvec=%d, enc_contributions=%d)" % (self.error, len(self.quorum_vvec),
                                                                                           len(self.enc_contributions))
 
+@compile_codec
 class msg_getcfilters:
     __slots__ = ("filter_type", "start_height", "stop_hash")
     msgtype =  b"getcfilters"
+    FIELDS = (
+        ("filter_type", uint8),
+        ("start_height", uint32),
+        ("stop_hash", uint256),
+    )
 
     def __init__(self, filter_type=None, start_height=None, stop_hash=None):
         self.filter_type = filter_type
         self.start_height = start_height
         self.stop_hash = stop_hash
 
-    def deserialize(self, f):
-        self.filter_type = struct.unpack("<B", f.read(1))[0]
-        self.start_height = struct.unpack("<I", f.read(4))[0]
-        self.stop_hash = deser_uint256(f)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += struct.pack("<I", self.start_height)
-        r += ser_uint256(self.stop_hash)
-        return r
-
     def __repr__(self):
         return "msg_getcfilters(filter_type={:#x}, start_height={}, stop_hash={:x})".format(
             self.filter_type, self.start_height, self.stop_hash)
 
+@compile_codec
 class msg_cfilter:
     __slots__ = ("filter_type", "block_hash", "filter_data")
     msgtype =  b"cfilter"
+    FIELDS = (
+        ("filter_type", uint8),
+        ("block_hash", uint256),
+        ("filter_data", var_bytes),
+    )
 
     def __init__(self, filter_type=None, block_hash=None, filter_data=None):
         self.filter_type = filter_type
         self.block_hash = block_hash
         self.filter_data = filter_data
 
-    def deserialize(self, f):
-        self.filter_type = struct.unpack("<B", f.read(1))[0]
-        self.block_hash = deser_uint256(f)
-        self.filter_data = deser_string(f)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += ser_uint256(self.block_hash)
-        r += ser_string(self.filter_data)
-        return r
-
     def __repr__(self):
         return "msg_cfilter(filter_type={:#x}, block_hash={:x})".format(
             self.filter_type, self.block_hash)
 
+@compile_codec
 class msg_getcfheaders:
     __slots__ = ("filter_type", "start_height", "stop_hash")
     msgtype =  b"getcfheaders"
+    FIELDS = (
+        ("filter_type", uint8),
+        ("start_height", uint32),
+        ("stop_hash", uint256),
+    )
 
     def __init__(self, filter_type=None, start_height=None, stop_hash=None):
         self.filter_type = filter_type
         self.start_height = start_height
         self.stop_hash = stop_hash
 
-    def deserialize(self, f):
-        self.filter_type = struct.unpack("<B", f.read(1))[0]
-        self.start_height = struct.unpack("<I", f.read(4))[0]
-        self.stop_hash = deser_uint256(f)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += struct.pack("<I", self.start_height)
-        r += ser_uint256(self.stop_hash)
-        return r
-
     def __repr__(self):
         return "msg_getcfheaders(filter_type={:#x}, start_height={}, stop_hash={:x})".format(
             self.filter_type, self.start_height, self.stop_hash)
 
+@compile_codec
 class msg_cfheaders:
     __slots__ = ("filter_type", "stop_hash", "prev_header", "hashes")
     msgtype =  b"cfheaders"
+    FIELDS = (
+        ("filter_type", uint8),
+        ("stop_hash", uint256),
+        ("prev_header", uint256),
+        ("hashes", uint256_vector),
+    )
 
     def __init__(self, filter_type=None, stop_hash=None, prev_header=None, hashes=None):
         self.filter_type = filter_type
@@ -2462,67 +2828,316 @@ class msg_cfheaders:
         self.prev_header = prev_header
         self.hashes = hashes
 
-    def deserialize(self, f):
-        self.filter_type = struct.unpack("<B", f.read(1))[0]
-        self.stop_hash = deser_uint256(f)
-        self.prev_header = deser_uint256(f)
-        self.hashes = deser_uint256_vector(f)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += ser_uint256(self.stop_hash)
-        r += ser_uint256(self.prev_header)
-        r += ser_uint256_vector(self.hashes)
-        return r
-
     def __repr__(self):
         return "msg_cfheaders(filter_type={:#x}, stop_hash={:x})".format(
             self.filter_type, self.stop_hash)
 
+@compile_codec
 class msg_getcfcheckpt:
     __slots__ = ("filter_type", "stop_hash")
     msgtype =  b"getcfcheckpt"
+    FIELDS = (
+        ("filter_type", uint8),
+        ("stop_hash", uint256),
+    )
 
     def __init__(self, filter_type=None, stop_hash=None):
         self.filter_type = filter_type
         self.stop_hash = stop_hash
 
-    def deserialize(self, f):
-        self.filter_type = struct.unpack("<B", f.read(1))[0]
-        self.stop_hash = deser_uint256(f)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += ser_uint256(self.stop_hash)
-        return r
-
     def __repr__(self):
         return "msg_getcfcheckpt(filter_type={:#x}, stop_hash={:x})".format(
             self.filter_type, self.stop_hash)
 
+@compile_codec
 class msg_cfcheckpt:
     __slots__ = ("filter_type", "stop_hash", "headers")
     msgtype =  b"cfcheckpt"
+    FIELDS = (
+        ("filter_type", uint8),
+        ("stop_hash", uint256),
+        ("headers", uint256_vector),
+    )
 
     def __init__(self, filter_type=None, stop_hash=None, headers=None):
         self.filter_type = filter_type
         self.stop_hash = stop_hash
         self.headers = headers
 
-    def deserialize(self, f):
-        self.filter_type = struct.unpack("<B", f.read(1))[0]
-        self.stop_hash = deser_uint256(f)
-        self.headers = deser_uint256_vector(f)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += ser_uint256(self.stop_hash)
-        r += ser_uint256_vector(self.headers)
-        return r
-
     def __repr__(self):
         return "msg_cfcheckpt(filter_type={:#x}, stop_hash={:x})".format(
             self.filter_type, self.stop_hash)
+
+
+class TestFrameworkMessages(unittest.TestCase):
+    def _make_block(self):
+        block = CBlock()
+        block.nVersion = 0x20000000
+        block.hashPrevBlock = 0x1234 << 200
+        block.nTime = 1700000000
+        block.nBits = 0x207fffff
+        for i in range(3):
+            tx = CTransaction()
+            tx.vin.append(CTxIn(COutPoint(i + 1, i), b"\x51" * i, 0xfffffffe))
+            tx.vout.append(CTxOut(i * COIN, b"\x6a" * (i + 250)))
+            tx.nLockTime = i
+            block.vtx.append(tx)
+        block.hashMerkleRoot = block.calc_merkle_root()
+        return block
+
+    def test_serialize_into(self):
+        """serialize() and serialize_into() agree with the field-by-field encoding"""
+        block = self._make_block()
+        expected = block.serialize_header() + ser_compact_size(len(block.vtx))
+        for tx in block.vtx:
+            expected += struct.pack("<i", tx.nVersion)
+            expected += ser_compact_size(1) + ser_uint256(tx.vin[0].prevout.hash) + struct.pack("<I", tx.vin[0].prevout.n)
+            expected += ser_string(tx.vin[0].scriptSig) + struct.pack("<I", tx.vin[0].nSequence)
+            expected += ser_compact_size(1) + struct.pack("<q", tx.vout[0].nValue) + ser_string(tx.vout[0].scriptPubKey)
+            expected += struct.pack("<I", tx.nLockTime)
+        self.assertEqual(block.serialize(), expected)
+        self.assertEqual(msg_block(block).serialize(), expected)
+        self.assertEqual(CBlockHeader.serialize(block), expected[:80])
+
+        r = bytearray(b"prefix")
+        block.serialize_into(r)
+        self.assertEqual(bytes(r), b"prefix" + expected)
+        self.assertEqual(ser_vector(block.vtx), expected[80:])
+        self.assertEqual(msg_headers([block]).serialize(), ser_compact_size(1) + expected[:80] + b"\x00")
+        self.assertEqual(ser_uint256(0x0102), b"\x02\x01" + b"\x00" * 30)
+
+    def test_hash_cache(self):
+        """Cached hashes are dropped when a serialized field is assigned"""
+        block = self._make_block()
+        tx = block.vtx[0]
+        tx.calc_sha256()
+        txid = tx.sha256
+        tx.nLockTime += 1
+        self.assertIsNone(tx.sha256)
+        tx.calc_sha256()
+        self.assertNotEqual(tx.sha256, txid)
+        self.assertEqual(tx.sha256, uint256_from_str(hash256(tx.serialize())))
+
+        block.calc_sha256()
+        block_hash = block.hash
+        block.vtx = []
+        self.assertEqual(block.hash, block_hash)
+        block.nNonce += 1
+        self.assertIsNone(block.sha256)
+        self.assertNotEqual(block.rehash(), int(block_hash, 16))
+
+    def test_hash_cache_copy(self):
+        """Copies keep the cached hashes of the original"""
+        block = self._make_block()
+        block.rehash()
+        for tx in block.vtx:
+            tx.rehash()
+        for copy_func in (copy.copy, copy.deepcopy, lambda obj: pickle.loads(pickle.dumps(obj))):
+            block_copy = copy_func(block)
+            self.assertEqual((block_copy.sha256, block_copy.hash), (block.sha256, block.hash))
+            tx_copy = copy_func(block.vtx[1])
+            self.assertEqual((tx_copy.sha256, tx_copy.hash), (block.vtx[1].sha256, block.vtx[1].hash))
+
+        block_copy = copy.deepcopy(block)
+        self.assertEqual([tx.hash for tx in block_copy.vtx], [tx.hash for tx in block.vtx])
+        block_copy.nNonce += 1
+        block_copy.rehash()
+        self.assertNotEqual(block_copy.hash, block.hash)
+        self.assertEqual(block_copy.hash, dashhash(block_copy.serialize_header())[::-1].hex())
+
+    def test_merkle_tree(self):
+        """Incremental merkle tree updates match a full recomputation"""
+        leaves = [sha256(bytes([i])) for i in range(17)]
+        tree = MerkleTree()
+        for i, h in enumerate(leaves):
+            tree.append(h)
+            self.assertEqual(tree.root(), CBlock.get_merkle_root(leaves[:i + 1]))
+        tree.replace(5, leaves[0])
+        self.assertEqual(tree.root(), CBlock.get_merkle_root(leaves[:5] + leaves[:1] + leaves[6:]))
+        for n in (16, 9, 1):
+            tree.update(leaves[:n])
+            self.assertEqual(tree.root(), CBlock.get_merkle_root(leaves[:n]))
+
+        block = self._make_block()
+        root = block.calc_merkle_root()
+        block.vtx.append(block.vtx[0])
+        self.assertEqual(block.calc_merkle_root(), CBlock.get_merkle_root([ser_uint256(tx.sha256) for tx in block.vtx]))
+        block.vtx.pop()
+        self.assertEqual(block.calc_merkle_root(), root)
+
+    def test_partial_merkle_tree(self):
+        """Partial merkle trees built from a MerkleTree prove the matched leaves"""
+        leaves = [sha256(bytes([i])) for i in range(11)]
+        tree = MerkleTree(leaves)
+        for matches in ([], [0], [3, 10], range(11)):
+            pmt = CPartialMerkleTree()
+            pmt.initialize_from_tree(tree, matches)
+            decoded = CPartialMerkleTree()
+            decoded.deserialize(ByteReader(pmt.serialize()))
+            root, found = decoded.extract_matches()
+            self.assertEqual(root, tree.root())
+            self.assertEqual(found, {i: uint256_from_str(leaves[i]) for i in matches})
+
+        block = self._make_block()
+        merkleblock = CMerkleBlock()
+        merkleblock.initialize_from_block(block, {block.vtx[1].sha256})
+        self.assertEqual(merkleblock.txn.extract_matches(), (block.hashMerkleRoot, {1: block.vtx[1].sha256}))
+
+    def test_dyn_bitset(self):
+        """DynBitSet round-trips and behaves like a list of bools"""
+        bools = [i % 3 == 0 for i in range(21)]
+        bitset = deser_dyn_bitset(ByteReader(ser_dyn_bitset(bools, False)), False)
+        self.assertEqual(bitset, bools)
+        self.assertEqual(bitset, DynBitSet(bools))
+        self.assertEqual(len(bitset), 21)
+        self.assertEqual((bitset.count(True), bitset.count(False), bitset.count(None)), (7, 14, 0))
+        self.assertEqual((bitset[0], bitset[1], bitset[-3]), (True, False, True))
+        self.assertEqual(ser_dyn_bitset(bitset, False), ser_compact_size(21) + bytes([0x49, 0x92, 0x04]))
+        bitset[1] = True
+        bitset[0] = False
+        self.assertEqual(bitset.to_list(), [False, True] + bools[2:])
+        self.assertRaises(IndexError, bitset.__getitem__, 21)
+        bitset.append(True)
+        bitset.extend([False, True])
+        self.assertEqual(bitset, [False, True] + bools[2:] + [True, False, True])
+        self.assertEqual(bitset.count(True), 9)
+
+        padded = deser_dyn_bitset(BytesIO(ser_dyn_bitset([True] * 3, True)), True)
+        self.assertEqual(padded, [True] * 3 + [False] * 5)
+
+    def test_lazy_decoding(self):
+        """Lazily decoded blocks and mnlistdiffs only decode their bodies on access"""
+        block = self._make_block()
+        raw = block.serialize()
+        msg = msg_block()
+        msg.deserialize(ByteReader(raw), lazy=True)
+        self.assertIsInstance(msg.block, LazyBlock)
+        self.assertEqual(len(msg.block._vtx_data), len(raw) - 80)
+        self.assertIn("vtx=<", repr(msg))
+        self.assertEqual(msg.serialize(), raw)
+        self.assertEqual(msg.block.rehash(), block.rehash())
+        self.assertEqual(len(msg.block.vtx), 3)
+        self.assertIsNone(msg.block._vtx_data)
+        self.assertEqual(msg.block.calc_merkle_root(), block.hashMerkleRoot)
+        self.assertEqual(msg.serialize(), raw)
+
+        mn = CSimplifiedMNListEntry()
+        mn.service.ip = "::"
+        mn.keyIDVoting = b"\x00" * 20
+        qc = CFinalCommitment()
+        qc.signers = [True] * 5
+        raw = (struct.pack("<H", 1) + ser_uint256(1) + ser_uint256(2) + CPartialMerkleTree().serialize() +
+               block.vtx[0].serialize() + ser_uint256_vector([3]) + ser_vector([mn]) +
+               ser_compact_size(1) + struct.pack("<B", 4) + ser_uint256(5) + ser_vector([qc]) +
+               ser_compact_size(1) + b"\x07" * 96 + ser_compact_size(1) + struct.pack("<H", 8))
+        lazy = msg_mnlistdiff()
+        lazy.deserialize(ByteReader(raw), lazy=True)
+        self.assertEqual(lazy.deletedMNs, [3])
+        self.assertIsNotNone(lazy._lazy_data)
+        self.assertEqual(lazy.newQuorums[0].signers, [True] * 5)
+        self.assertIsNone(lazy._lazy_data)
+        eager = msg_mnlistdiff()
+        eager.deserialize(ByteReader(raw))
+        self.assertEqual(lazy.mnList[0].serialize(), eager.mnList[0].serialize())
+        self.assertEqual(lazy.deletedQuorums, [QuorumId(4, 5)])
+        self.assertEqual(lazy.quorumsCLSigs, {b"\x07" * 96: {8}})
+
+    def test_from_hex(self):
+        """Batch hex decoding matches FromHex"""
+        block = self._make_block()
+        hex_txs = [tx.serialize().hex() for tx in block.vtx]
+        txs = txs_from_hex(hex_txs)
+        self.assertEqual([tx.serialize().hex() for tx in txs], hex_txs)
+        self.assertEqual([tx.rehash() for tx in txs], [FromHex(CTransaction(), h).rehash() for h in hex_txs])
+        self.assertRaises(ValueError, txs_from_hex, [hex_txs[0] + "00", hex_txs[1]])
+
+        block.solve()
+        block_json = {
+            "hash": block.hash,
+            "version": block.nVersion,
+            "previousblockhash": "%064x" % block.hashPrevBlock,
+            "merkleroot": "%064x" % block.hashMerkleRoot,
+            "time": block.nTime,
+            "bits": "%08x" % block.nBits,
+            "nonce": block.nNonce,
+            "tx": [{"txid": tx.hash, "hex": h} for tx, h in zip(block.vtx, hex_txs)],
+        }
+        self.assertEqual(block_from_rpc_verbose(block_json).serialize(), block.serialize())
+
+    def test_compiled_codec(self):
+        """Codecs compiled from FIELDS match the field-by-field encoding"""
+        isdlock = msg_isdlock(1, [COutPoint(2, 3)], 4, 5, b"\x06" * 96)
+        expected = (struct.pack("<B", 1) + ser_compact_size(1) + ser_uint256(2) + struct.pack("<I", 3) +
+                    ser_uint256(4) + ser_uint256(5) + b"\x06" * 96)
+        self.assertEqual(isdlock.serialize(), expected)
+        decoded = msg_isdlock()
+        decoded.deserialize(ByteReader(expected))
+        self.assertEqual((decoded.nVersion, decoded.txid, decoded.cycleHash, decoded.sig), (1, 4, 5, b"\x06" * 96))
+        self.assertEqual((decoded.inputs[0].hash, decoded.inputs[0].n), (2, 3))
+
+        filterload = msg_filterload(b"\xaa" * 3, 11, 12, 1)
+        expected = ser_string(b"\xaa" * 3) + struct.pack("<IIB", 11, 12, 1)
+        self.assertEqual(filterload.serialize(), expected)
+        decoded = msg_filterload()
+        decoded.deserialize(BytesIO(expected))
+        self.assertEqual(decoded.serialize(), expected)
+
+        # Raw byte fields are written unchanged, even with an unexpected length
+        clsig = msg_clsig(-1, 2, b"\x03")
+        self.assertEqual(clsig.serialize(), struct.pack("<i", -1) + ser_uint256(2) + b"\x03")
+        self.assertRaises(struct.error, msg_clsig().deserialize, ByteReader(clsig.serialize()))
+
+    def test_byte_reader(self):
+        """ByteReader and BytesIO decode to the same objects"""
+        raw = self._make_block().serialize()
+        from_reader = CBlock()
+        from_reader.deserialize(ByteReader(raw))
+        from_stream = CBlock()
+        from_stream.deserialize(BytesIO(raw))
+        self.assertEqual(from_reader.serialize(), raw)
+        self.assertEqual(from_stream.serialize(), raw)
+        self.assertEqual(FromHex(CBlock(), raw.hex()).serialize(), raw)
+
+        f = ByteReader(ser_compact_size(0x10000) + ser_uint256(7) + b"\x01")
+        self.assertEqual(deser_compact_size(f), 0x10000)
+        self.assertEqual(deser_uint256(f), 7)
+        self.assertEqual(f.read(), b"\x01")
+        self.assertRaises(struct.error, deser_uint256, f)
+        self.assertRaises(struct.error, deser_uint256, BytesIO(b"\x00" * 31))
+
+    def test_headers2(self):
+        """headers2 compression round-trips and refers to versions by their recency"""
+        headers = []
+        prev, ntime = 0, 1000
+        chain = [(1, 10, 1), (2, 10, 1), (3, 10, 1), (2, 10, 40000), (1, 11, -5)]
+        chain += [(v, 11, 1) for v in (9, 8, 7, 6, 5, 4, 1, 10, 11, 12, 13, 14, 15, 16, 1)]
+        for i, (version, nbits, time_step) in enumerate(chain):
+            ntime += time_step
+            header = CBlockHeader()
+            header.nVersion, header.hashPrevBlock, header.hashMerkleRoot = version, prev, i
+            header.nTime, header.nBits, header.nNonce = ntime, nbits, i
+            header.rehash()
+            prev = header.sha256
+            headers.append(header)
+
+        msg = msg_headers2([CompressibleBlockHeader(h) for h in headers])
+        raw = msg.serialize()
+        flags = [h.bitfield for h in msg.headers]
+        F = CompressibleBlockHeader
+        self.assertEqual(flags[0], F.FLAG_PREV_BLOCK_HASH | F.FLAG_TIMESTAMP | F.FLAG_NBITS)
+        self.assertEqual(flags[1:3], [0, 0])
+        # Version 2 was used two headers ago, with a timestamp that doesn't fit 16 bits
+        self.assertEqual(flags[3], 2 | F.FLAG_TIMESTAMP)
+        # Version 1 is third most recent after that, and nBits changes
+        self.assertEqual(flags[4], 3 | F.FLAG_NBITS)
+        # Version 1 is the oldest of the 7 most recently used, until seven
+        # newer versions have evicted it
+        self.assertEqual(flags[11], 7)
+        self.assertEqual(flags[19], 0)
+
+        decoded = msg_headers2()
+        decoded.deserialize(ByteReader(raw))
+        self.assertEqual([h.sha256 for h in decoded.headers], [h.sha256 for h in headers])
+        self.assertEqual([(h.nVersion, h.nTime, h.nBits) for h in decoded.headers],
+                         [(h.nVersion, h.nTime, h.nBits) for h in headers])
+        self.assertEqual(decoded.serialize(), raw)
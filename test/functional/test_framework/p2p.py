@@ -21,17 +21,29 @@ P2PTxInvStore: A p2p interface class that inherits from P2PDataStore, and keeps
               a count of how many times each txid has been announced.
 """
 import asyncio
-from collections import defaultdict
-from io import BytesIO
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import logging
-import struct
 import sys
 import threading
-
+import time
+import unittest
+
+from test_framework.framing import (
+    DecodeStats,
+    MSG_HEADER,
+    build_frame,
+    frame_checksum,
+    is_loopback,
+    parse_header,
+)
 from test_framework.messages import (
+    ByteReader,
+    CInv,
     CBlockHeader,
     CompressibleBlockHeader,
     MAX_HEADERS_RESULTS,
+    MAX_INV_SIZE,
     MIN_VERSION_SUPPORTED,
     NODE_HEADERS_COMPRESSED,
     msg_addr,
@@ -80,7 +92,6 @@ from test_framework.messages import (
     MSG_TX,
     MSG_TYPE_MASK,
     NODE_NETWORK,
-    sha256,
 )
 from test_framework.util import wait_until
 
@@ -138,6 +149,9 @@ MESSAGEMAP = {
     b"spork": None,
 }
 
+# Message types that can be deserialized lazily, see P2PConnection.lazy_decoding
+LAZY_MSGTYPES = {b"block", b"mnlistdiff"}
+
 MAGIC_BYTES = {
     "mainnet": b"\xbf\x0c\x6b\xbd",   # mainnet
     "testnet3": b"\xce\xe2\xca\xff",  # testnet3
@@ -145,6 +159,53 @@ MAGIC_BYTES = {
     "devnet": b"\xe2\xca\xff\xce",    # devnet
 }
 
+# Number of announced txids P2PTxInvStore keeps count of
+MAX_TX_INVS_RECEIVED = 100000
+
+
+class BoundedHistory:
+    """The most recent items appended, oldest first.
+
+    At most maxlen items are kept; appending to a full history drops the
+    oldest item. Membership tests and count() are O(1), using a count of the
+    items currently kept."""
+    __slots__ = ("items", "counts")
+
+    def __init__(self, maxlen):
+        self.items = deque(maxlen=maxlen)
+        self.counts = Counter()
+
+    def append(self, item):
+        if len(self.items) == self.items.maxlen:
+            oldest = self.items[0]
+            self.counts[oldest] -= 1
+            if not self.counts[oldest]:
+                del self.counts[oldest]
+        self.items.append(item)
+        self.counts[item] += 1
+
+    def count(self, item):
+        return self.counts[item]
+
+    def clear(self):
+        self.items.clear()
+        self.counts.clear()
+
+    def __contains__(self, item):
+        return item in self.counts
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        return self.items[i]
+
+    def __repr__(self):
+        return "BoundedHistory(%r)" % list(self.items)
+
 
 class P2PConnection(asyncio.Protocol):
     """A low-level connection object to a node's P2P interface.
@@ -163,6 +224,34 @@ class P2PConnection(asyncio.Protocol):
         # The underlying transport of the connection.
         # Should only call methods on this from the NetworkThread, c.f. call_soon_threadsafe
         self._transport = None
+        # Only decode the headers of block and mnlistdiff messages on receipt, and
+        # their transactions and lists on first access.
+        self.lazy_decoding = False
+        # If set, only messages of these types are deserialized and passed to
+        # on_message(). The payloads of all other messages go to on_raw_message().
+        self.subscribed_msgtypes = None
+        # If unset, the checksums of messages received from a loopback address
+        # are not verified. Connections to other hosts always verify them.
+        self.verify_checksums = True
+        self._trusted_peer = False
+        # If set to a DecodeStats, the time spent deserializing each received
+        # message is added to it.
+        self.decode_stats = None
+        # The event loop servicing this connection, see NetworkThread
+        self._event_loop = None
+        # The lock guarding the state of this connection, see p2p_lock
+        self.p2p_lock = p2p_lock
+        # Messages waiting to be written by the event loop, see send_raw_messages()
+        self._send_queue = []
+        self._send_queue_lock = threading.Lock()
+        self._flush_scheduled = False
+        # Cleared while the transport's write buffer is full
+        self._can_write = threading.Event()
+        self._can_write.set()
+        # Received bytes not yet deserialized into messages
+        self.recvbuf = bytearray()
+        # Number of received bytes dropped from the front of recvbuf
+        self._recv_offset = 0
 
     @property
     def is_connected(self):
@@ -173,9 +262,11 @@ class P2PConnection(asyncio.Protocol):
         self.timeout_factor = timeout_factor
         self.dstaddr = dstaddr
         self.dstport = dstport
+        self._trusted_peer = is_loopback(dstaddr)
         # The initial message to send after the connection was made:
         self.on_connection_send_msg = None
-        self.recvbuf = b""
+        self.recvbuf = bytearray()
+        self._recv_offset = 0
         self.magic_bytes = MAGIC_BYTES[net]
         self.uacomment = uacomment
 
@@ -192,14 +283,14 @@ class P2PConnection(asyncio.Protocol):
 
         logger.debug('Connecting to Dash Node: %s:%d' % (self.dstaddr, self.dstport))
 
-        loop = NetworkThread.network_event_loop
+        loop = self._event_loop = NetworkThread.next_event_loop()
         conn_gen_unsafe = loop.create_connection(lambda: self, host=self.dstaddr, port=self.dstport)
         conn_gen = lambda: loop.call_soon_threadsafe(loop.create_task, conn_gen_unsafe)
         return conn_gen
 
     def peer_disconnect(self):
         # Connection could have already been closed by other end.
-        NetworkThread.network_event_loop.call_soon_threadsafe(lambda: self._transport and self._transport.abort())
+        self._event_loop.call_soon_threadsafe(lambda: self._transport and self._transport.abort())
 
     # Connection and disconnection methods
 
@@ -212,6 +303,8 @@ class P2PConnection(asyncio.Protocol):
             self.send_message(self.on_connection_send_msg)
             self.on_connection_send_msg = None  # Never used again
         self.on_open()
+        with self.p2p_lock:
+            self.p2p_lock.notify_all()
 
     def connection_lost(self, exc):
         """asyncio callback when a connection is closed."""
@@ -220,8 +313,24 @@ class P2PConnection(asyncio.Protocol):
         else:
             logger.debug("Closed connection to: %s:%d" % (self.dstaddr, self.dstport))
         self._transport = None
-        self.recvbuf = b""
+        self.recvbuf = bytearray()
+        self._recv_offset = 0
+        # Don't leave senders blocked on a write buffer that will never drain
+        self._can_write.set()
+        if self.decode_stats is not None:
+            for line in self.decode_stats.report():
+                logger.debug("Decoded from %s:%d: %s" % (self.dstaddr, self.dstport, line))
         self.on_close()
+        with self.p2p_lock:
+            self.p2p_lock.notify_all()
+
+    def pause_writing(self):
+        """asyncio callback when the transport's write buffer is full."""
+        self._can_write.clear()
+
+    def resume_writing(self):
+        """asyncio callback when the transport's write buffer has drained."""
+        self._can_write.set()
 
     # Socket read methods
 
@@ -236,44 +345,70 @@ class P2PConnection(asyncio.Protocol):
 
         This method reads data from the buffer in a loop. It deserializes,
         parses and verifies the P2P header, then passes the P2P payload to
-        the on_message callback for processing."""
+        the on_message callback for processing.
+
+        Messages are parsed in place, starting at an offset into the buffer.
+        The consumed bytes are only dropped once no complete message is
+        left, so a large message arriving in many chunks is not copied again
+        for every chunk."""
+        pos = 0
         try:
             while True:
-                if len(self.recvbuf) < 4:
+                available = len(self.recvbuf) - pos
+                if available < 4:
                     return
-                if self.recvbuf[:4] != self.magic_bytes:
-                    raise ValueError("magic bytes mismatch: {} != {}".format(repr(self.magic_bytes), repr(self.recvbuf)))
-                if len(self.recvbuf) < 4 + 12 + 4 + 4:
+                if self.recvbuf[pos:pos+4] != self.magic_bytes:
+                    raise ValueError("magic bytes mismatch: {} != {}".format(repr(self.magic_bytes), repr(bytes(self.recvbuf[pos:]))))
+                if available < MSG_HEADER.size:
                     return
-                msgtype = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                checksum = self.recvbuf[4+12+4:4+12+4+4]
-                if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
+                msgtype, msglen, checksum = parse_header(self.recvbuf, pos)
+                if available < MSG_HEADER.size + msglen:
                     return
-                msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
-                th = sha256(msg)
-                h = sha256(th)
-                if checksum != h[:4]:
-                    raise ValueError("got bad checksum " + repr(self.recvbuf))
-                self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
+                start = pos + MSG_HEADER.size
+                with memoryview(self.recvbuf) as view:
+                    msg = view[start:start+msglen].tobytes()
+                if (self.verify_checksums or not self._trusted_peer) and checksum != frame_checksum(msg):
+                    raise ValueError("got bad checksum " + repr(bytes(self.recvbuf[pos:])))
+                offset = self._recv_offset + pos
+                pos = start + msglen
                 if msgtype not in MESSAGEMAP:
                     raise ValueError("Received unknown msgtype from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, msgtype, repr(msg)))
-                if MESSAGEMAP[msgtype] is None:
+                if MESSAGEMAP[msgtype] is None or (self.subscribed_msgtypes is not None and msgtype not in self.subscribed_msgtypes):
                     # Command is known but we don't want/need to handle it
+                    self.on_raw_message(msgtype, msg, offset)
                     continue
-                f = BytesIO(msg)
+                decode_stats = self.decode_stats
+                if decode_stats is not None:
+                    decode_start = time.perf_counter()
+                f = ByteReader(msg)
                 t = MESSAGEMAP[msgtype]()
-                t.deserialize(f)
+                if self.lazy_decoding and msgtype in LAZY_MSGTYPES:
+                    t.deserialize(f, lazy=True)
+                else:
+                    t.deserialize(f)
+                if decode_stats is not None:
+                    decode_stats.add(msgtype, time.perf_counter() - decode_start)
                 self._log_message("receive", t)
                 self.on_message(t)
         except Exception as e:
-            logger.exception('Error reading message:', repr(e))
+            logger.exception('Error reading message: %s', repr(e))
             raise
+        finally:
+            # Deleting from the front of a bytearray does not move the rest
+            del self.recvbuf[:pos]
+            self._recv_offset += pos
 
     def on_message(self, message):
         """Callback for processing a P2P payload. Must be overridden by derived class."""
         raise NotImplementedError
 
+    def on_raw_message(self, msgtype, payload, offset):
+        """Callback for a message that is not deserialized.
+
+        offset is the position of the message header in the stream of bytes
+        received on this connection."""
+        pass
+
     # Socket write methods
 
     def send_message(self, message):
@@ -285,33 +420,70 @@ class P2PConnection(asyncio.Protocol):
         self._log_message("send", message)
         return self.send_raw_message(tmsg)
 
+    def send_messages(self, messages):
+        """Send several P2P messages over the socket.
+
+        Like send_message(), but all messages are queued at once, so they are
+        written to the socket together. While the transport's write buffer is
+        full, this blocks until it has drained, see _wait_until_writable()."""
+        self._wait_until_writable()
+        frames = []
+        for message in messages:
+            frames.append(self.build_message(message))
+            self._log_message("send", message)
+        self.send_raw_messages(frames)
+
     def send_raw_message(self, raw_message_bytes):
+        self.send_raw_messages([raw_message_bytes])
+
+    def send_raw_messages(self, raw_messages):
+        """Queue raw messages to be written by the event loop.
+
+        Messages queued before the event loop gets to them are written with a
+        single writelines() call."""
         if not self.is_connected:
             raise IOError('Not connected')
 
-        def maybe_write():
-            if not self._transport:
+        with self._send_queue_lock:
+            self._send_queue.extend(raw_messages)
+            if self._flush_scheduled:
                 return
-            if self._transport.is_closing():
-                return
-            self._transport.write(raw_message_bytes)
-        NetworkThread.network_event_loop.call_soon_threadsafe(maybe_write)
+            self._flush_scheduled = True
+        self._event_loop.call_soon_threadsafe(self._flush_send_queue)
+
+    def _flush_send_queue(self):
+        with self._send_queue_lock:
+            raw_messages, self._send_queue = self._send_queue, []
+            self._flush_scheduled = False
+        if not self._transport:
+            return
+        if self._transport.is_closing():
+            return
+        self._transport.writelines(raw_messages)
+
+    def _wait_until_writable(self):
+        """Block while the transport's write buffer is full.
+
+        The event loop never blocks, since it is what drains the buffer.
+        Neither do callers holding p2p_lock: the event loop needs it to
+        deliver incoming messages, and the node may stop reading from the
+        socket until those are consumed."""
+        if self._in_event_loop() or self.p2p_lock._is_owned():
+            return
+        if not self._can_write.wait(timeout=60 * self.timeout_factor or None):
+            raise IOError('Timed out waiting for the send buffer to drain')
+
+    def _in_event_loop(self):
+        try:
+            return asyncio.get_running_loop() is self._event_loop
+        except RuntimeError:
+            return False
 
     # Class utility methods
 
     def build_message(self, message):
         """Build a serialized P2P message"""
-        msgtype = message.msgtype
-        data = message.serialize()
-        tmsg = self.magic_bytes
-        tmsg += msgtype
-        tmsg += b"\x00" * (12 - len(msgtype))
-        tmsg += struct.pack("<I", len(data))
-        th = sha256(data)
-        h = sha256(th)
-        tmsg += h[:4]
-        tmsg += data
-        return tmsg
+        return build_frame(self.magic_bytes, message.msgtype, message.serialize())
 
     def _log_message(self, direction, msg):
         """Logs a message being sent or received over the connection."""
@@ -334,8 +506,24 @@ class P2PInterface(P2PConnection):
 
     Individual testcases should subclass this and override the on_* methods
     if they want to alter message handling behaviour."""
-    def __init__(self, support_addrv2=False):
+    # Message types that are always deserialized, because the connection
+    # handshake and sync_with_ping() depend on them
+    REQUIRED_MSGTYPES = frozenset((b"version", b"verack", b"ping", b"pong"))
+
+    def __init__(self, support_addrv2=False, lazy_decoding=False, own_lock=False,
+                 subscribe=None, raw_history_size=0, verify_checksums=True, time_decoding=False):
         super().__init__()
+        self.lazy_decoding = lazy_decoding
+        self.verify_checksums = verify_checksums
+        if time_decoding:
+            self.decode_stats = DecodeStats()
+        if subscribe is not None:
+            self.subscribed_msgtypes = self.REQUIRED_MSGTYPES.union(subscribe)
+        if own_lock:
+            # Guard this connection's state with its own lock instead of the
+            # global p2p_lock, so that it does not contend with other
+            # connections. Tests must then use self.p2p_lock to access it.
+            self.p2p_lock = threading.Condition()
 
         # Track number of messages of each type received.
         # Should be read-only in a test.
@@ -346,6 +534,14 @@ class P2PInterface(P2PConnection):
         # this and use wait_until.
         self.last_message = {}
 
+        # Track number of messages of each type that were not deserialized,
+        # because their type is not handled or not subscribed to.
+        self.raw_message_count = defaultdict(int)
+
+        # The raw_history_size most recent of those messages, as
+        # (msgtype, payload, offset) tuples, see on_raw_message().
+        self.raw_messages = deque(maxlen=raw_history_size)
+
         # A count of the number of ping messages we've sent to the node
         self.ping_counter = 1
 
@@ -377,16 +573,25 @@ class P2PInterface(P2PConnection):
 
         We keep a count of how many of each message type has been received
         and the most recent message of each type."""
-        with p2p_lock:
+        with self.p2p_lock:
             try:
                 msgtype = message.msgtype.decode('ascii')
                 self.message_count[msgtype] += 1
                 self.last_message[msgtype] = message
                 getattr(self, 'on_' + msgtype)(message)
+                # Wake up threads waiting in wait_until() for this message
+                self.p2p_lock.notify_all()
             except:
                 print("ERROR delivering %s (%s)" % (repr(message), sys.exc_info()[0]))
                 raise
 
+    def on_raw_message(self, msgtype, payload, offset):
+        with self.p2p_lock:
+            self.raw_message_count[msgtype.decode('ascii')] += 1
+            if self.raw_messages.maxlen:
+                self.raw_messages.append((msgtype, payload, offset))
+            self.p2p_lock.notify_all()
+
     # Callback methods. Can be overridden by subclasses in individual test
     # cases to provide custom message handling behaviour.
 
@@ -458,7 +663,7 @@ class P2PInterface(P2PConnection):
     # Connection helper methods
 
     def wait_until(self, test_function, timeout=60):
-        wait_until(test_function, timeout=timeout, lock=p2p_lock, timeout_factor=self.timeout_factor)
+        wait_until(test_function, timeout=timeout, lock=self.p2p_lock, timeout_factor=self.timeout_factor)
 
     def wait_for_disconnect(self, timeout=60):
         test_function = lambda: not self.is_connected
@@ -471,14 +676,21 @@ class P2PInterface(P2PConnection):
             assert self.is_connected
             if not self.last_message.get('tx'):
                 return False
-            return self.last_message['tx'].tx.rehash() == txid
+            # Received messages are not mutated, so the cached hash can be used.
+            tx = self.last_message['tx'].tx
+            tx.calc_sha256()
+            return tx.hash == txid
 
         self.wait_until(test_function, timeout=timeout)
 
     def wait_for_block(self, blockhash, timeout=60):
         def test_function():
             assert self.is_connected
-            return self.last_message.get("block") and self.last_message["block"].block.rehash() == blockhash
+            if not self.last_message.get("block"):
+                return False
+            block = self.last_message["block"].block
+            block.calc_sha256()
+            return block.sha256 == blockhash
 
         self.wait_until(test_function, timeout=timeout)
 
@@ -488,7 +700,8 @@ class P2PInterface(P2PConnection):
             last_headers = self.last_message.get('headers')
             if not last_headers:
                 return False
-            return last_headers.headers[0].rehash() == int(blockhash, 16)
+            last_headers.headers[0].calc_sha256()
+            return last_headers.headers[0].sha256 == int(blockhash, 16)
 
         self.wait_until(test_function, timeout=timeout)
 
@@ -498,10 +711,10 @@ class P2PInterface(P2PConnection):
             last_filtered_block = self.last_message.get('merkleblock')
             if not last_filtered_block:
                 return False
-            return last_filtered_block.merkleblock.header.rehash() == int(blockhash, 16)
-
-        wait_until(test_function, timeout=timeout, lock=p2p_lock)
+            last_filtered_block.merkleblock.header.calc_sha256()
+            return last_filtered_block.merkleblock.header.sha256 == int(blockhash, 16)
 
+        self.wait_until(test_function, timeout=timeout)
 
     def wait_for_getdata(self, hash_list, timeout=60):
         """Waits for a getdata message.
@@ -569,36 +782,67 @@ class P2PInterface(P2PConnection):
         self.ping_counter += 1
 
 
-# One lock for synchronizing all data access between the network event loop (see
+# One lock for synchronizing all data access between the network event loops (see
 # NetworkThread below) and the thread running the test logic.  For simplicity,
-# P2PConnection acquires this lock whenever delivering a message to a P2PInterface.
+# P2PConnection acquires this lock whenever delivering a message to a P2PInterface,
+# unless the P2PInterface was created with its own lock (see own_lock).
 # This lock should be acquired in the thread running the test logic to synchronize
 # access to any data shared with the P2PInterface or P2PConnection.
-p2p_lock = threading.Lock()
+# It is a condition variable that is notified whenever a message has been
+# delivered or a connection was opened or closed, so wait_until() with this lock
+# returns as soon as its predicate becomes true instead of polling.
+p2p_lock = threading.Condition()
 
 
 class NetworkThread(threading.Thread):
+    """Runs the asyncio event loops that service the P2P connections.
+
+    By default there is a single event loop, run by this thread. With
+    num_loops > 1, each additional loop is run by a helper thread and new
+    connections are assigned to the loops in turn, so that the traffic of
+    many connections is not all handled by one thread."""
     network_event_loop = None
+    # All event loops, network_event_loop first
+    network_event_loops = []
+    _next_loop = 0
 
-    def __init__(self):
+    def __init__(self, num_loops=1):
         super().__init__(name="NetworkThread")
-        # There is only one event loop and no more than one thread must be created
+        # There is only one network thread, which owns all event loops
         assert not self.network_event_loop
 
-        NetworkThread.network_event_loop = asyncio.new_event_loop()
+        NetworkThread.network_event_loops = [asyncio.new_event_loop() for _ in range(num_loops)]
+        NetworkThread.network_event_loop = NetworkThread.network_event_loops[0]
+        NetworkThread._next_loop = 0
+        self.helper_threads = [threading.Thread(name="NetworkThread-%d" % i, target=loop.run_forever)
+                               for i, loop in enumerate(self.network_event_loops[1:], 1)]
+
+    @classmethod
+    def next_event_loop(cls):
+        """Return the event loop to service the next new connection."""
+        loop = cls.network_event_loops[cls._next_loop % len(cls.network_event_loops)]
+        cls._next_loop += 1
+        return loop
 
     def run(self):
         """Start the network thread."""
+        for thread in self.helper_threads:
+            thread.start()
         self.network_event_loop.run_forever()
 
     def close(self, timeout=10):
-        """Close the connections and network event loop."""
-        self.network_event_loop.call_soon_threadsafe(self.network_event_loop.stop)
-        wait_until(lambda: not self.network_event_loop.is_running(), timeout=timeout)
-        self.network_event_loop.close()
+        """Close the connections and network event loops."""
+        for loop in self.network_event_loops:
+            loop.call_soon_threadsafe(loop.stop)
+        wait_until(lambda: not any(loop.is_running() for loop in self.network_event_loops), timeout=timeout)
+        for loop in self.network_event_loops:
+            loop.close()
+        for thread in self.helper_threads:
+            thread.join(timeout)
         self.join(timeout)
-        # Safe to remove event loop.
+        # Safe to remove event loops.
         NetworkThread.network_event_loop = None
+        NetworkThread.network_event_loops = []
 
 class P2PDataStore(P2PInterface):
     """A P2P data store class.
@@ -612,7 +856,18 @@ class P2PDataStore(P2PInterface):
         self.last_block_hash = ''
         # store of txs. key is txid, value is a CTransaction object
         self.tx_store = {}
-        self.getdata_requests = []
+        # hashes of the most recently requested objects
+        self.getdata_requests = BoundedHistory(MAX_INV_SIZE)
+        # The chain of block hashes ending at last_block_hash, oldest first, and
+        # the index of each hash in it. Updated on demand by _update_chain().
+        self._chain = []
+        self._chain_index = {}
+        # Serialized block messages, prepared ahead of time by
+        # send_blocks_and_test() with a window. key is block hash.
+        self.block_frames = {}
+        # Compressible copies of the headers of block_store, made on the first
+        # getheaders2 that asks for them. key is block hash.
+        self.compressible_headers = {}
 
     def on_getdata(self, message):
         """Check for the tx/block in our stores and if found, reply with an inv message."""
@@ -620,45 +875,70 @@ class P2PDataStore(P2PInterface):
             self.getdata_requests.append(inv.hash)
             if (inv.type & MSG_TYPE_MASK) == MSG_TX and inv.hash in self.tx_store.keys():
                 self.send_message(msg_tx(self.tx_store[inv.hash]))
+            elif (inv.type & MSG_TYPE_MASK) == MSG_BLOCK and inv.hash in self.block_frames:
+                logger.debug("Send prepared block message for {:064x}".format(inv.hash))
+                self.send_raw_message(self.block_frames[inv.hash])
             elif (inv.type & MSG_TYPE_MASK) == MSG_BLOCK and inv.hash in self.block_store.keys():
                 self.send_message(msg_block(self.block_store[inv.hash]))
             else:
                 logger.debug('getdata message type {} received.'.format(hex(inv.type)))
 
-    def _compute_requested_block_headers(self, locator, hash_stop):
+    def _update_chain(self):
+        """Make the cached chain end at last_block_hash.
+
+        Only the blocks that are not on the cached chain yet are walked, so
+        extending the tip or a short reorg are cheap."""
+        branch = []
+        block_hash = self.last_block_hash
+        while block_hash in self.block_store and block_hash not in self._chain_index:
+            branch.append(block_hash)
+            block_hash = self.block_store[block_hash].hashPrevBlock
+        # Drop the blocks after the fork point, or the whole chain if the
+        # branch does not connect to it
+        fork = self._chain_index.get(block_hash, -1)
+        for stale_hash in self._chain[fork + 1:]:
+            del self._chain_index[stale_hash]
+        del self._chain[fork + 1:]
+        for block_hash in reversed(branch):
+            self._chain_index[block_hash] = len(self._chain)
+            self._chain.append(block_hash)
+
+    def _compute_requested_block_hashes(self, locator, hash_stop):
         # Assume that the most recent block added is the tip
         if not self.block_store:
             return
 
-        headers_list = [self.block_store[self.last_block_hash]]
-        while headers_list[-1].sha256 not in locator.vHave:
-            # Walk back through the block store, adding headers to headers_list
-            # as we go.
-            prev_block_hash = headers_list[-1].hashPrevBlock
-            if prev_block_hash in self.block_store:
-                prev_block_header = CBlockHeader(self.block_store[prev_block_hash])
-                headers_list.append(prev_block_header)
-                if prev_block_header.sha256 == hash_stop:
-                    # if this is the hashstop header, stop here
-                    break
-            else:
-                logger.debug('block hash {} not found in block store'.format(hex(prev_block_hash)))
-                break
+        self._update_chain()
+        # Start at the most recent block of the chain that is in the locator,
+        # or at the oldest one if there is none, but not before hash_stop
+        tip = len(self._chain) - 1
+        start = max((self._chain_index[h] for h in locator.vHave if h in self._chain_index), default=0)
+        stop = self._chain_index.get(hash_stop)
+        if stop is not None and start < stop < tip:
+            start = stop
 
         # Truncate the list if there are too many headers
-        headers_list = headers_list[:-MAX_HEADERS_RESULTS - 1:-1]
+        return self._chain[start:start + MAX_HEADERS_RESULTS]
 
-        return headers_list
+    def _compute_requested_block_headers(self, locator, hash_stop):
+        block_hashes = self._compute_requested_block_hashes(locator, hash_stop)
+        if block_hashes is None:
+            return
+        return [CBlockHeader(self.block_store[h]) for h in block_hashes]
 
     def on_getheaders2(self, message):
-        """Search back through our block store for the locator, and reply with a compressed headers message if found."""
-
-        headers_list = self._compute_requested_block_headers(message.locator, message.hashstop)
-        compressible_headers_list = [CompressibleBlockHeader(h) for h in headers_list] if headers_list else None
-        response = msg_headers2(compressible_headers_list)
-
-        if response is not None:
-            self.send_message(response)
+        """Search back through our block store for the locator, and reply with a compressed headers message if found.
+
+        The compressible headers are kept across responses, so every block is
+        copied and hashed once, and msg_headers2 only has to recompute their
+        bitfields."""
+        headers_list = []
+        for block_hash in self._compute_requested_block_hashes(message.locator, message.hashstop) or []:
+            header = self.compressible_headers.get(block_hash)
+            if header is None:
+                header = self.compressible_headers[block_hash] = CompressibleBlockHeader(self.block_store[block_hash])
+            headers_list.append(header)
+        self.send_message(msg_headers2(headers_list))
 
     def on_getheaders(self, message):
         """Search back through our block store for the locator, and reply with a headers message if found."""
@@ -669,7 +949,7 @@ class P2PDataStore(P2PInterface):
         if response is not None:
             self.send_message(response)
 
-    def send_blocks_and_test(self, blocks, node, *, success=True, force_send=False, reject_reason=None, expect_disconnect=False, timeout=60):
+    def send_blocks_and_test(self, blocks, node, *, success=True, force_send=False, reject_reason=None, expect_disconnect=False, timeout=60, window=None):
         """Send blocks to test node and test whether the tip advances.
 
          - add all blocks to our block_store
@@ -677,18 +957,23 @@ class P2PDataStore(P2PInterface):
          - the on_getheaders handler will ensure that any getheaders are responded to
          - if force_send is False: wait for getdata for each of the blocks. The on_getdata handler will
            ensure that any getdata messages are responded to. Otherwise send the full block unsolicited.
+         - if window is set: send the blocks in chunks of that many blocks, see _send_blocks_pipelined()
          - if success is True: assert that the node's tip advances to the most recent block
          - if success is False: assert that the node's tip doesn't advance
          - if reject_reason is set: assert that the correct reject message is logged"""
 
-        with p2p_lock:
+        with self.p2p_lock:
             for block in blocks:
                 self.block_store[block.sha256] = block
                 self.last_block_hash = block.sha256
+                # A block with the same hash may have had different contents
+                self.block_frames.pop(block.sha256, None)
 
         reject_reason = [reject_reason] if reject_reason else []
         with node.assert_debug_log(expected_msgs=reject_reason):
-            if force_send:
+            if window:
+                self._send_blocks_pipelined(blocks, window, force_send=force_send, timeout=timeout)
+            elif force_send:
                 for b in blocks:
                     self.send_message(msg_block(block=b))
             else:
@@ -705,6 +990,42 @@ class P2PDataStore(P2PInterface):
             else:
                 assert node.getbestblockhash() != blocks[-1].hash
 
+    def _send_blocks_pipelined(self, blocks, window, *, force_send, timeout):
+        """Send blocks in chunks of window blocks.
+
+        A worker thread serializes the blocks ahead of the chunk being sent,
+        at most two windows ahead. The headers of the next chunk are sent as
+        soon as the node requested the last block of the current one, so the
+        node always has blocks to download. With force_send, each chunk is
+        sent unsolicited and followed by a ping instead."""
+        def serialize(block):
+            return block.sha256, self.build_message(msg_block(block))
+
+        pending = deque()
+        remaining = iter(blocks)
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                for i in range(0, len(blocks), window):
+                    for block in remaining:
+                        pending.append(executor.submit(serialize, block))
+                        if len(pending) >= 2 * window:
+                            break
+                    chunk = blocks[i:i + window]
+                    frames = [pending.popleft().result() for _ in chunk]
+                    if force_send:
+                        for _, frame in frames:
+                            self.send_raw_message(frame)
+                        self.sync_with_ping(timeout=timeout)
+                    else:
+                        with self.p2p_lock:
+                            self.block_frames.update(frames)
+                        self.send_message(msg_headers([CBlockHeader(block) for block in chunk]))
+                        self.wait_until(lambda: chunk[-1].sha256 in self.getdata_requests, timeout=timeout)
+        finally:
+            with self.p2p_lock:
+                for block in blocks:
+                    self.block_frames.pop(block.sha256, None)
+
     def send_txs_and_test(self, txs, node, *, success=True, expect_disconnect=False, reject_reason=None):
         """Send txs to test node and test whether they're accepted to the mempool.
 
@@ -714,7 +1035,7 @@ class P2PDataStore(P2PInterface):
          - if expect_disconnect is True: Skip the sync with ping
          - if reject_reason is set: assert that the correct reject message is logged."""
 
-        with p2p_lock:
+        with self.p2p_lock:
             for tx in txs:
                 self.tx_store[tx.sha256] = tx
 
@@ -739,10 +1060,13 @@ class P2PDataStore(P2PInterface):
                     assert tx.hash not in raw_mempool, "{} tx found in mempool".format(tx.hash)
 
 class P2PTxInvStore(P2PInterface):
-    """A P2PInterface which stores a count of how many times each txid has been announced."""
-    def __init__(self):
+    """A P2PInterface which stores a count of how many times each txid has been announced.
+
+    Only the max_tx_invs txids announced first are kept."""
+    def __init__(self, max_tx_invs=MAX_TX_INVS_RECEIVED):
         super().__init__()
         self.tx_invs_received = defaultdict(int)
+        self.max_tx_invs = max_tx_invs
 
     def on_inv(self, message):
         super().on_inv(message) # Send getdata in response.
@@ -751,9 +1075,12 @@ class P2PTxInvStore(P2PInterface):
             if i.type == MSG_TX:
                 # save txid
                 self.tx_invs_received[i.hash] += 1
+                if len(self.tx_invs_received) > self.max_tx_invs:
+                    # Forget the txid announced first
+                    del self.tx_invs_received[next(iter(self.tx_invs_received))]
 
     def get_invs(self):
-        with p2p_lock:
+        with self.p2p_lock:
             return list(self.tx_invs_received.keys())
 
     def wait_for_broadcast(self, txns, timeout=60):
@@ -764,3 +1091,74 @@ class P2PTxInvStore(P2PInterface):
         self.wait_until(lambda: set(self.tx_invs_received.keys()) == set([int(tx, 16) for tx in txns]), timeout)
         # Flush messages and wait for the getdatas to be processed
         self.sync_with_ping()
+
+
+class TestFrameworkP2P(unittest.TestCase):
+    def test_bounded_history(self):
+        history = BoundedHistory(3)
+        for item in (1, 2, 1, 3):
+            history.append(item)
+        self.assertEqual(list(history), [2, 1, 3])
+        self.assertEqual((history.count(1), len(history), history[-1]), (1, 3, 3))
+        history.append(4)
+        self.assertNotIn(2, history)
+        self.assertIn(1, history)
+        history.append(5)
+        self.assertNotIn(1, history)
+        self.assertEqual(list(history), [3, 4, 5])
+        history.clear()
+        self.assertEqual((len(history), history.count(3)), (0, 0))
+
+    def test_subscription(self):
+        peer = P2PInterface(subscribe=[b"headers"], raw_history_size=1)
+        peer.dstaddr, peer.dstport = "127.0.0.1", 0
+        peer.magic_bytes = MAGIC_BYTES["regtest"]
+        inv = peer.build_message(msg_inv([CInv(MSG_TX, 1)]))
+        headers = peer.build_message(msg_headers())
+        stream = inv + headers + inv
+        # Deliver the stream in chunks that split messages
+        for i in range(0, len(stream), 7):
+            peer.data_received(stream[i:i + 7])
+        self.assertEqual(peer.message_count["headers"], 1)
+        self.assertNotIn("inv", peer.message_count)
+        self.assertEqual(peer.raw_message_count["inv"], 2)
+        self.assertEqual(list(peer.raw_messages), [(b"inv", inv[MSG_HEADER.size:], len(inv + headers))])
+
+    def test_send_backpressure(self):
+        class Loop:
+            def call_soon_threadsafe(self, callback):
+                pass
+
+        peer = P2PInterface()
+        peer._transport, peer._event_loop, peer.timeout_factor = object(), Loop(), 0.001
+        peer.dstaddr, peer.dstport = "127.0.0.1", 0
+        peer.magic_bytes = MAGIC_BYTES["regtest"]
+        peer.pause_writing()
+        # Single messages are queued, as are batches sent with p2p_lock held
+        peer.send_message(msg_ping(1))
+        with peer.p2p_lock:
+            peer.send_messages([msg_ping(2), msg_ping(3)])
+        self.assertEqual(len(peer._send_queue), 3)
+        # Other batches wait for the write buffer to drain
+        with self.assertRaises(IOError):
+            peer.send_messages([msg_ping(4)])
+        peer.resume_writing()
+        peer.send_messages([msg_ping(4)])
+        self.assertEqual(len(peer._send_queue), 4)
+
+    def test_checksum(self):
+        for host, verify_checksums, accepted in (("127.0.0.1", True, False), ("10.0.0.1", False, False),
+                                                 ("127.0.0.1", False, True)):
+            peer = P2PInterface(verify_checksums=verify_checksums, time_decoding=True)
+            peer.dstaddr, peer.dstport = host, 0
+            peer._trusted_peer = is_loopback(host)
+            peer.magic_bytes = MAGIC_BYTES["regtest"]
+            stream = bytearray(peer.build_message(msg_headers()))
+            stream[MSG_HEADER.size - 1] ^= 0xff
+            if accepted:
+                peer.data_received(bytes(stream))
+                self.assertEqual(peer.message_count["headers"], 1)
+                self.assertEqual(peer.decode_stats.count, {b"headers": 1})
+            else:
+                with self.assertLogs(logger, "ERROR"), self.assertRaisesRegex(ValueError, "bad checksum"):
+                    peer.data_received(bytes(stream))
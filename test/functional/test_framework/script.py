@@ -11,7 +11,9 @@ import unittest
 from typing import List, Dict
 
 from .messages import (
+    COutPoint,
     CTransaction,
+    CTxIn,
     CTxOut,
     hash256,
     sha256,
@@ -626,10 +628,9 @@ def SignatureHash(script, txTo, inIdx, hashtype):
 
     if inIdx >= len(txTo.vin):
         return (HASH_ONE, "inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
-    txtmp = CTransaction(txTo)
-
-    for txin in txtmp.vin:
-        txin.scriptSig = b''
+    # Only the inputs are modified below, so share everything else with txTo
+    txtmp = txTo.clone()
+    txtmp.vin = [CTxIn(txin.prevout, b'', txin.nSequence) for txin in txtmp.vin]
     txtmp.vin[inIdx].scriptSig = FindAndDelete(script, CScript([OP_CODESEPARATOR]))
 
     if (hashtype & 0x1f) == SIGHASH_NONE:
@@ -693,3 +694,26 @@ class TestFrameworkScript(unittest.TestCase):
         values = [0, 1, -1, -2, 127, 128, -255, 256, (1 << 15) - 1, -(1 << 16), (1 << 24) - 1, (1 << 31), 1 - (1 << 32), 1 << 40, 1500, -1500]
         for value in values:
             self.assertEqual(CScriptNum.decode(CScriptNum.encode(CScriptNum(value))), value)
+
+    def test_signature_hash(self):
+        """SignatureHash commits to the expected fields and leaves txTo unchanged"""
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(i + 1, i), bytes([0x51] * (i + 1)), 0xfffffffe) for i in range(3)]
+        tx.vout = [CTxOut(i, bytes([0x52] * i)) for i in range(3)]
+        raw = tx.serialize()
+        script = CScript([OP_CHECKSIG])
+
+        expected = CTransaction(tx)
+        for txin in expected.vin:
+            txin.scriptSig = b''
+        expected.vin[1].scriptSig = script
+        self.assertEqual(SignatureHash(script, tx, 1, SIGHASH_ALL),
+                         (hash256(expected.serialize() + struct.pack("<I", SIGHASH_ALL)), None))
+
+        expected.vin = [expected.vin[1]]
+        expected.vout = []
+        hashtype = SIGHASH_NONE | SIGHASH_ANYONECANPAY
+        self.assertEqual(SignatureHash(script, tx, 1, hashtype),
+                         (hash256(expected.serialize() + struct.pack("<I", hashtype)), None))
+        self.assertEqual(SignatureHash(script, tx, 2, SIGHASH_SINGLE)[1], None)
+        self.assertEqual(tx.serialize(), raw)
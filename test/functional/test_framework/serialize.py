@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 The Dash Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Serialization primitives shared by the test framework.
+
+These are the hottest functions of the framework: every message field goes
+through them. They use precompiled struct.Struct objects, int.from_bytes for
+uint256 values and a lookup table for single-byte compact sizes, instead of
+parsing a format string on every call.
+
+test_framework.messages re-exports all of them, which is where tests should
+import them from."""
+
+import struct
+import unittest
+from io import BytesIO
+
+UINT8 = struct.Struct("<B")
+UINT16 = struct.Struct("<H")
+INT16 = struct.Struct("<h")
+INT32 = struct.Struct("<i")
+UINT32 = struct.Struct("<I")
+INT64 = struct.Struct("<q")
+UINT64 = struct.Struct("<Q")
+
+UINT256_MASK = (1 << 256) - 1
+
+# Encodings of all compact sizes that fit in a single byte
+_COMPACT_SIZE_TABLE = tuple(bytes((i,)) for i in range(253))
+_COMPACT_SIZE_16 = struct.Struct("<BH")
+_COMPACT_SIZE_32 = struct.Struct("<BI")
+_COMPACT_SIZE_64 = struct.Struct("<BQ")
+
+
+class ByteReader:
+    """A read-only cursor over a bytes-like object.
+
+    Reads are served from a memoryview of the underlying buffer, so decoding a
+    message does not copy the payload. Fixed-width fields are decoded in place
+    with struct.unpack_from/int.from_bytes. read() behaves like BytesIO.read(),
+    so a ByteReader can be passed to any deserialize() method."""
+    __slots__ = ("_view", "_pos")
+
+    def __init__(self, data, pos=0):
+        self._view = memoryview(data).cast("B")
+        self._pos = pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, n=-1):
+        start = self._pos
+        end = len(self._view) if n is None or n < 0 else min(start + n, len(self._view))
+        self._pos = end
+        return self._view[start:end].tobytes()
+
+    def unpack(self, st):
+        """Unpack the precompiled struct.Struct st at the cursor and advance past it."""
+        r = st.unpack_from(self._view, self._pos)
+        self._pos += st.size
+        return r
+
+    def read_uint256(self):
+        start = self._pos
+        if start + 32 > len(self._view):
+            raise struct.error("unpack requires a buffer of 32 bytes")
+        self._pos = start + 32
+        return int.from_bytes(self._view[start:start + 32], "little")
+
+    def read_compact_size(self):
+        nit = UINT8.unpack_from(self._view, self._pos)[0]
+        self._pos += 1
+        if nit == 253:
+            return self.unpack(UINT16)[0]
+        elif nit == 254:
+            return self.unpack(UINT32)[0]
+        elif nit == 255:
+            return self.unpack(UINT64)[0]
+        return nit
+
+
+def deser_struct(f, st):
+    """Unpack the precompiled struct.Struct st from f, in place if f is a ByteReader."""
+    if isinstance(f, ByteReader):
+        return f.unpack(st)
+    return st.unpack(f.read(st.size))
+
+
+def ser_compact_size(l):
+    if 0 <= l < 253:
+        return _COMPACT_SIZE_TABLE[l]
+    elif l < 0x10000:
+        return _COMPACT_SIZE_16.pack(253, l)
+    elif l < 0x100000000:
+        return _COMPACT_SIZE_32.pack(254, l)
+    return _COMPACT_SIZE_64.pack(255, l)
+
+
+def deser_compact_size(f):
+    if isinstance(f, ByteReader):
+        return f.read_compact_size()
+    nit = UINT8.unpack(f.read(1))[0]
+    if nit == 253:
+        nit = UINT16.unpack(f.read(2))[0]
+    elif nit == 254:
+        nit = UINT32.unpack(f.read(4))[0]
+    elif nit == 255:
+        nit = UINT64.unpack(f.read(8))[0]
+    return nit
+
+
+def deser_string(f):
+    nit = deser_compact_size(f)
+    return f.read(nit)
+
+
+def ser_string(s):
+    return ser_compact_size(len(s)) + s
+
+
+def ser_string_into(r, s):
+    r += ser_compact_size(len(s))
+    r += s
+
+
+def deser_uint256(f):
+    if isinstance(f, ByteReader):
+        return f.read_uint256()
+    s = f.read(32)
+    if len(s) != 32:
+        raise struct.error("unpack requires a buffer of 32 bytes")
+    return int.from_bytes(s, "little")
+
+
+def ser_uint256(u):
+    return (u & UINT256_MASK).to_bytes(32, "little")
+
+
+def uint256_from_str(s):
+    if len(s) < 32:
+        raise struct.error("unpack requires a buffer of 32 bytes")
+    return int.from_bytes(s[:32], "little")
+
+
+class TestFrameworkSerialize(unittest.TestCase):
+    def test_compact_size(self):
+        for n, encoded in ((0, "00"), (252, "fc"), (253, "fdfd00"), (0xffff, "fdffff"),
+                           (0x10000, "fe00000100"), (0xffffffff, "feffffffff"),
+                           (0x100000000, "ff0000000001000000")):
+            self.assertEqual(ser_compact_size(n).hex(), encoded)
+            self.assertEqual(deser_compact_size(BytesIO(bytes.fromhex(encoded))), n)
+            self.assertEqual(deser_compact_size(ByteReader(bytes.fromhex(encoded))), n)
+        self.assertRaises(struct.error, ser_compact_size, -1)
+
+    def test_uint256(self):
+        value = sum(i << (8 * i) for i in range(32))
+        encoded = bytes(range(32))
+        self.assertEqual(ser_uint256(value), encoded)
+        self.assertEqual(ser_uint256(-1), b"\xff" * 32)
+        self.assertEqual(uint256_from_str(encoded + b"\xff"), value)
+        self.assertEqual(deser_uint256(BytesIO(encoded)), value)
+        self.assertEqual(deser_uint256(ByteReader(encoded)), value)
+        self.assertRaises(struct.error, uint256_from_str, encoded[:31])
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 The Dash Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Snapshots of node datadirs, kept in the test cache directory.
+
+A snapshot holds the chain directories of a set of nodes together with some
+JSON metadata. It is identified by a name and a key, such as the chain and the
+extra_args of the nodes, so that tests that set up the same state can share
+it. Snapshots are published atomically, so tests running in parallel can
+build the same snapshot without seeing each other's partial copies.
+
+Snapshots are kept per build of dashd, since the state a node writes to disk,
+such as its evodb and LLMQ databases, may not be usable by another build.
+flush_cache() lets them survive test_runner.py emptying the cache directory
+until dashd is rebuilt.
+
+Datadirs are cloned rather than copied where possible: LevelDB table files
+are never modified once written, so they are hard-linked, and other files are
+reflinked on filesystems that support it, or copied otherwise."""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Bump this when snapshots written by an older framework can't be used anymore
+SNAPSHOT_VERSION = 1
+
+# Files that are specific to one run of a node and are not part of a snapshot
+VOLATILE_FILES = ("debug.log", ".lock", ".cookie", "*.pid", "stdout", "stderr")
+
+# From linux/fs.h
+_FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    """Copy src to dst, sharing data with src if that is safe and possible.
+
+    Usable as the copy_function of shutil.copytree()."""
+    if src.endswith(".ldb"):
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            # Not supported by the filesystem, fall back to copying
+            pass
+    return shutil.copy2(src, dst)
+
+
+def clone_tree(src, dst, ignore=None):
+    """Copy the directory tree src to dst with clone_file()."""
+    shutil.copytree(src, dst, ignore=ignore, copy_function=clone_file)
+
+
+def build_id(binary):
+    """Return an identifier of the build of the binary at path binary."""
+    st = os.stat(binary)
+    return "%x-%x" % (st.st_size, st.st_mtime_ns)
+
+
+def flush_cache(cachedir, binary):
+    """Empty the cache directory, except for the snapshots made with binary."""
+    try:
+        entries = os.listdir(cachedir)
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry != "snapshots":
+            path = os.path.join(cachedir, entry)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+    try:
+        keep = build_id(binary)
+    except OSError:
+        keep = None
+    snapshots = os.path.join(cachedir, "snapshots")
+    for entry in os.listdir(snapshots) if os.path.isdir(snapshots) else []:
+        if entry != keep:
+            shutil.rmtree(os.path.join(snapshots, entry), ignore_errors=True)
+
+
+class SnapshotCache:
+    """The snapshots made with the dashd at path binary in a cache directory."""
+
+    def __init__(self, cachedir, binary):
+        self.dir = os.path.join(cachedir, "snapshots", build_id(binary))
+
+    def path(self, name, key):
+        """Return the directory of the snapshot name with the JSON serializable key."""
+        digest = hashlib.sha256(json.dumps([SNAPSHOT_VERSION, name, key], sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.dir, "%s-%s" % ("".join(c if c.isalnum() else "_" for c in name), digest[:16]))
+
+    def load(self, name, key):
+        """Return the metadata of a snapshot, or None if there is none."""
+        try:
+            with open(os.path.join(self.path(name, key), "metadata.json"), encoding="utf8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, name, key, chain_dirs, metadata):
+        """Save the chain directories of stopped nodes as a snapshot.
+
+        If another process saved the same snapshot first, that one is kept."""
+        path = self.path(name, key)
+        os.makedirs(self.dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.dir, prefix=".tmp-")
+        try:
+            for i, chain_dir in enumerate(chain_dirs):
+                clone_tree(chain_dir, os.path.join(tmp, "node%d" % i), ignore=shutil.ignore_patterns(*VOLATILE_FILES))
+            with open(os.path.join(tmp, "metadata.json"), "w", encoding="utf8") as f:
+                json.dump(metadata, f)
+            os.rename(tmp, path)
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def restore(self, name, key, chain_dirs):
+        """Replace the chain directories of stopped nodes with a snapshot."""
+        path = self.path(name, key)
+        if not os.path.isdir(path):
+            raise FileNotFoundError(errno.ENOENT, "Snapshot '%s' disappeared from the cache" % name, path)
+        for i, chain_dir in enumerate(chain_dirs):
+            shutil.rmtree(chain_dir, ignore_errors=True)
+            clone_tree(os.path.join(path, "node%d" % i), chain_dir)
+
+
+class TestFrameworkSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def make_chain_dir(self, name):
+        chain_dir = os.path.join(self.dir, name, "regtest")
+        os.makedirs(os.path.join(chain_dir, "chainstate"))
+        for path, content in (("chainstate/000005.ldb", b"table"), ("chainstate/MANIFEST-000004", b"manifest"),
+                              ("debug.log", b"log"), (".cookie", b"cookie")):
+            with open(os.path.join(chain_dir, path), "wb") as f:
+                f.write(content)
+        return chain_dir
+
+    def test_clone_tree(self):
+        src = self.make_chain_dir("src")
+        dst = os.path.join(self.dir, "dst")
+        clone_tree(src, dst)
+        for path in ("chainstate/000005.ldb", "chainstate/MANIFEST-000004"):
+            with open(os.path.join(dst, path), "rb") as f1, open(os.path.join(src, path), "rb") as f2:
+                self.assertEqual(f1.read(), f2.read())
+        # Table files are shared, everything else is a copy of its own
+        self.assertTrue(os.path.samefile(os.path.join(src, "chainstate/000005.ldb"), os.path.join(dst, "chainstate/000005.ldb")))
+        self.assertFalse(os.path.samefile(os.path.join(src, "chainstate/MANIFEST-000004"), os.path.join(dst, "chainstate/MANIFEST-000004")))
+
+    def make_binary(self, content):
+        binary = os.path.join(self.dir, "dashd")
+        with open(binary, "wb") as f:
+            f.write(content)
+        return binary
+
+    def test_snapshot(self):
+        cache = SnapshotCache(os.path.join(self.dir, "cache"), self.make_binary(b"dashd"))
+        key = ["regtest", [["-txindex"]]]
+        self.assertIsNone(cache.load("4 masternodes", key))
+        self.assertNotEqual(cache.path("4 masternodes", key), cache.path("4 masternodes", ["regtest", [[]]]))
+
+        chain_dirs = [self.make_chain_dir("node0")]
+        cache.save("4 masternodes", key, chain_dirs, {"mocktime": 5})
+        self.assertEqual(cache.load("4 masternodes", key), {"mocktime": 5})
+        # A snapshot saved concurrently by someone else is kept
+        cache.save("4 masternodes", key, chain_dirs, {"mocktime": 6})
+        self.assertEqual(cache.load("4 masternodes", key), {"mocktime": 5})
+        self.assertEqual(os.listdir(cache.dir), [os.path.basename(cache.path("4 masternodes", key))])
+
+        target = [os.path.join(self.dir, "restored", "regtest")]
+        cache.restore("4 masternodes", key, target)
+        self.assertEqual(sorted(os.listdir(target[0])), ["chainstate"])
+
+        shutil.rmtree(cache.path("4 masternodes", key))
+        with self.assertRaises(FileNotFoundError):
+            cache.restore("4 masternodes", key, target)
+        # The chain directories are left alone
+        self.assertEqual(sorted(os.listdir(target[0])), ["chainstate"])
+
+    def test_flush_cache(self):
+        cachedir = os.path.join(self.dir, "cache")
+        binary = self.make_binary(b"dashd")
+        cache = SnapshotCache(cachedir, binary)
+        cache.save("setup", [], [self.make_chain_dir("node0")], {})
+        os.makedirs(os.path.join(cachedir, "node0"))
+        with open(os.path.join(cachedir, "cache.lock"), "w", encoding="utf8"):
+            pass
+
+        flush_cache(cachedir, binary)
+        self.assertEqual(os.listdir(cachedir), ["snapshots"])
+        self.assertEqual(cache.load("setup", []), {})
+
+        # Rebuilding dashd invalidates the snapshots
+        self.make_binary(b"rebuilt dashd")
+        flush_cache(cachedir, binary)
+        self.assertEqual(os.listdir(os.path.join(cachedir, "snapshots")), [])
+        self.assertIsNone(SnapshotCache(cachedir, binary).load("setup", []))
+        flush_cache(os.path.join(self.dir, "missing"), binary)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 The Dash Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""A swarm of lightweight test peers for load-testing a node's connection handling.
+
+TestNode.add_p2p_connection() handshakes with one peer at a time. A PeerSwarm
+opens all of its connections at once on the network event loops, so the
+node sees them arrive concurrently and the version/verack handshakes run in
+parallel. This is meant for exercising the connection manager, inbound
+eviction and -maxconnections.
+
+SwarmPeer only deserializes the handshake messages and pings. Everything else
+the node sends, including inv, is counted but not decoded. Each peer records
+when it connected, finished the handshake and received its first inv, and
+the number of bytes it sent and received. PeerSwarm.stats() aggregates them.
+
+Peers connect to the node (they are inbound from the node's point of view),
+since the node cannot be told to open connections to the framework."""
+
+import threading
+import time
+import unittest
+
+from test_framework.p2p import P2PInterface
+from test_framework.util import p2p_port, wait_until
+
+
+def percentile(values, p):
+    """Return the p-th percentile (0-100) of values, by nearest rank."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+class SwarmPeer(P2PInterface):
+    """A test peer that keeps track of its timing and traffic.
+
+    All times are seconds since the connection was started. State is guarded
+    by the lock of the swarm the peer belongs to."""
+
+    def __init__(self, lock, **kwargs):
+        kwargs.setdefault("subscribe", ())
+        super().__init__(**kwargs)
+        self.p2p_lock = lock
+        self.start_time = None
+        self.connect_latency = None
+        self.handshake_latency = None
+        self.first_inv_latency = None
+        self.disconnected = False
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    def peer_connect(self, *args, **kwargs):
+        create_conn = super().peer_connect(*args, **kwargs)
+
+        def start():
+            self.start_time = time.perf_counter()
+            create_conn()
+        return start
+
+    def _elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    def data_received(self, t):
+        self.bytes_received += len(t)
+        super().data_received(t)
+
+    def send_raw_messages(self, raw_messages):
+        # Messages are sent from both the test and the network thread
+        with self._send_queue_lock:
+            self.bytes_sent += sum(len(m) for m in raw_messages)
+        super().send_raw_messages(raw_messages)
+
+    def on_open(self):
+        with self.p2p_lock:
+            self.connect_latency = self._elapsed()
+
+    def on_close(self):
+        with self.p2p_lock:
+            self.disconnected = True
+
+    def on_verack(self, message):
+        self.handshake_latency = self._elapsed()
+
+    def on_raw_message(self, msgtype, payload, offset):
+        if msgtype == b"inv" and self.first_inv_latency is None:
+            self.first_inv_latency = self._elapsed()
+        super().on_raw_message(msgtype, payload, offset)
+
+
+class PeerSwarm:
+    """A group of SwarmPeers connected to one node.
+
+    All peers share a single lock, so waiting for a condition over the whole
+    swarm wakes up once per message instead of polling every peer."""
+
+    def __init__(self, node, num_peers, peer_class=SwarmPeer, **peer_kwargs):
+        self.node = node
+        self.lock = threading.Condition()
+        self.peers = [peer_class(self.lock, **peer_kwargs) for _ in range(num_peers)]
+
+    def connect(self, *, wait_for_handshake=True, timeout=60, **kwargs):
+        """Open all connections at once.
+
+        With wait_for_handshake, return once every peer has either finished
+        the handshake or been disconnected, since a node at its connection
+        limit may drop peers right away."""
+        if 'dstport' not in kwargs:
+            kwargs['dstport'] = p2p_port(self.node.index)
+        if 'dstaddr' not in kwargs:
+            kwargs['dstaddr'] = '127.0.0.1'
+        starts = [peer.peer_connect(**kwargs, net=self.node.chain, timeout_factor=self.node.timeout_factor)
+                  for peer in self.peers]
+        for start in starts:
+            start()
+        self.node.p2ps.extend(self.peers)
+        if wait_for_handshake:
+            self.wait_until(lambda: all(p.handshake_latency is not None or p.disconnected for p in self.peers),
+                            timeout=timeout)
+
+    def wait_until(self, test_function, timeout=60):
+        wait_until(test_function, timeout=timeout, lock=self.lock, timeout_factor=self.node.timeout_factor)
+
+    def wait_for_inv(self, timeout=60):
+        """Wait until every connected peer has received an inv."""
+        self.wait_until(lambda: all(p.first_inv_latency is not None or p.disconnected for p in self.peers),
+                        timeout=timeout)
+
+    def connected_peers(self):
+        with self.lock:
+            return [p for p in self.peers if p.is_connected and not p.disconnected]
+
+    def disconnect(self):
+        for peer in self.peers:
+            peer.peer_disconnect()
+        self.wait_until(lambda: all(p.disconnected or p.connect_latency is None for p in self.peers))
+
+    def stats(self):
+        """Return a dict of aggregate statistics of the swarm.
+
+        Latencies (in seconds) and byte counts per peer are given as
+        (median, 90th percentile, max) tuples, over the peers that got that
+        far."""
+        with self.lock:
+            def summary(values):
+                values = [v for v in values if v is not None]
+                return (percentile(values, 50), percentile(values, 90), max(values, default=None))
+            return {
+                "peers": len(self.peers),
+                "connected": sum(1 for p in self.peers if p.connect_latency is not None and not p.disconnected),
+                "handshaked": sum(1 for p in self.peers if p.handshake_latency is not None),
+                "disconnected": sum(1 for p in self.peers if p.disconnected),
+                "connect_latency": summary(p.connect_latency for p in self.peers),
+                "handshake_latency": summary(p.handshake_latency for p in self.peers),
+                "first_inv_latency": summary(p.first_inv_latency for p in self.peers),
+                "bytes_received": summary(p.bytes_received for p in self.peers),
+                "bytes_sent": summary(p.bytes_sent for p in self.peers),
+            }
+
+
+class TestFrameworkSwarm(unittest.TestCase):
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(percentile([3, 1, 2], 50), 2)
+        self.assertEqual(percentile(range(1, 101), 90), 90)
+        self.assertEqual(percentile(range(1, 101), 100), 100)
+        self.assertEqual(percentile([5], 0), 5)
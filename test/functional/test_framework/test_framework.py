@@ -10,6 +10,7 @@ import copy
 from _decimal import Decimal, ROUND_DOWN
 from enum import Enum
 import argparse
+import json
 import logging
 import os
 import pdb
@@ -19,8 +20,10 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
+import unittest
+from concurrent.futures import ThreadPoolExecutor, wait as wait_for_futures
 
 from typing import List
 from .authproxy import JSONRPCException
@@ -36,6 +39,7 @@ from .messages import (
 )
 from .script import hash160
 from .p2p import NetworkThread
+from .snapshot import SnapshotCache, clone_tree
 from .test_node import TestNode
 from .util import (
     PortSeed,
@@ -68,6 +72,14 @@ TEST_EXIT_SKIPPED = 77
 
 TMPDIR_PREFIX = "dash_func_test_"
 
+# Set on the threads of TestFramework.node_executor, see for_each_node()
+_node_thread = threading.local()
+
+
+def _mark_node_thread():
+    _node_thread.active = True
+
+
 class SkipTest(Exception):
     """This exception is raised to skip a test"""
 
@@ -120,6 +132,10 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         self.setup_clean_chain: bool = False
         self.nodes: List[TestNode] = []
         self.network_thread = None
+        # Threads for calling all nodes at once, see for_each_node()
+        self.node_executor = None
+        # Number of event loops servicing P2P connections, see NetworkThread
+        self.num_network_loops = 1
         self.mocktime = 0
         self.rpc_timeout = 60  # Wait for up to 60 seconds for the RPC server to respond
         self.supports_cli = True
@@ -292,7 +308,7 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         self.log.debug("PRNG seed is: {}".format(seed))
 
         self.log.debug('Setting up network thread')
-        self.network_thread = NetworkThread()
+        self.network_thread = NetworkThread(num_loops=self.num_network_loops)
         self.network_thread.start()
 
         if self.options.usecli:
@@ -326,6 +342,9 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
             for node in self.nodes:
                 node.cleanup_on_exit = False
             self.log.info("Note: dashds were not stopped and may still be running")
+        if self.node_executor is not None:
+            self.node_executor.shutdown()
+            self.node_executor = None
 
         should_clean_up = (
             not self.options.nocleanup and
@@ -579,7 +598,7 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         # But we flush all state changes to disk via gettxoutsetinfo call and
         # we don't care about wallets, so it works
         self.nodes[0].gettxoutsetinfo()
-        shutil.copytree(source_data_dir, new_data_dir)
+        clone_tree(source_data_dir, new_data_dir)
 
         shutil.rmtree(os.path.join(new_data_dir, self.chain, 'wallets'))
         shutil.rmtree(os.path.join(new_data_dir, self.chain, 'llmq'))
@@ -639,8 +658,7 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         try:
             for i, node in enumerate(self.nodes):
                 node.start(extra_args[i], *args, **kwargs)
-            for node in self.nodes:
-                node.wait_for_rpc_connection()
+            self.wait_for_rpc_connections(self.nodes)
         except:
             # If one node failed to start, stop the others
             self.stop_nodes()
@@ -656,13 +674,107 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
 
     def stop_nodes(self, expected_stderr='', wait=0):
         """Stop multiple dashd test nodes"""
+        # Issue RPC to stop nodes
+        self.for_each_node(lambda node: node.stop_node(expected_stderr=expected_stderr, wait=wait, wait_until_stopped=False))
+        # Wait for nodes to stop
+        self.for_each_node(lambda node: node.wait_until_stopped())
+
+    def for_each_node(self, func, nodes=None):
+        """Call func on each of nodes (default: all nodes) concurrently.
+
+        nodes may also be other per-node objects, such as MasternodeInfo.
+
+        Returns the results in the order of nodes. If a call raises, the first
+        exception in that order is raised once all calls have finished.
+
+        The threads are kept for the lifetime of the framework, since this is
+        called on every poll of sync_blocks() and sync_mempools(). Calls made
+        from within func run one node after the other in the calling thread,
+        as waiting for the same threads would deadlock."""
+        if nodes is None:
+            nodes = self.nodes
+        if len(nodes) <= 1 or getattr(_node_thread, 'active', False):
+            return [func(node) for node in nodes]
+        if self.node_executor is None:
+            self.node_executor = ThreadPoolExecutor(max_workers=MAX_NODES, thread_name_prefix="node",
+                                                    initializer=_mark_node_thread)
+        futures = [self.node_executor.submit(func, node) for node in nodes]
+        wait_for_futures(futures)
+        return [future.result() for future in futures]
+
+    def wait_for_rpc_connections(self, nodes):
+        """Wait for the RPC servers of started nodes to come up, concurrently."""
+        start = time.time()
+        self.for_each_node(lambda node: node.wait_for_rpc_connection(), nodes)
+        if nodes:
+            slowest = max(nodes, key=lambda node: node.startup_latency)
+            self.log.debug("Started %d nodes in %.2fs, slowest was node %d after %.2fs" %
+                           (len(nodes), time.time() - start, slowest.index, slowest.startup_latency))
+
+    def cached_state(self, name, build, key=None):
+        """Bring the nodes into a state that is only built once per cache directory.
+
+        The first test to ask for the state calls build() and saves the chain
+        directories of all nodes, the mocktime and the result of build(),
+        which must be JSON serializable, as a snapshot. Tests asking for it
+        later restore the snapshot instead. Either way the nodes are then
+        restarted and reconnected as they were, and the result of build() is
+        returned.
+
+        The snapshot is identified by name and by the chain and
+        cached_state_key(), plus key if given.
+
+        Snapshots are kept across runs of test_runner.py until dashd is
+        rebuilt, see snapshot.flush_cache()."""
+        cache = SnapshotCache(self.options.cachedir, self.options.bitcoind)
+        key = [self.chain, self.cached_state_key(), key]
+        metadata = cache.load(name, key)
+        if metadata is None:
+            self.log.info("Building cached state '%s'" % name)
+            result = build()
+            metadata = {"mocktime": self.mocktime, "connections": self._outbound_connections(), "result": result}
+            self.stop_nodes()
+            cache.save(name, key, self._chain_dirs(), metadata)
+        else:
+            self.log.info("Restoring cached state '%s'" % name)
+            self.stop_nodes()
+            cache.restore(name, key, self._chain_dirs())
+        self.mocktime = metadata["mocktime"]
         for node in self.nodes:
-            # Issue RPC to stop nodes
-            node.stop_node(expected_stderr=expected_stderr, wait=wait, wait_until_stopped=False)
+            node.mocktime = self.mocktime
+        self.start_cached_nodes(metadata)
+        return metadata["result"]
 
-        for node in self.nodes:
-            # Wait for nodes to stop
-            node.wait_until_stopped()
+    def cached_state_key(self):
+        """Return what the cached states of this test depend on: the number of nodes and their extra_args."""
+        return [node.extra_args for node in self.nodes]
+
+    def start_cached_nodes(self, metadata):
+        """Start the nodes of a cached state that was just built or restored.
+
+        metadata holds the mocktime, the connections between the nodes and
+        the result of build(). The nodes are started and reconnected."""
+        self.start_nodes()
+        for a, b in metadata["connections"]:
+            self.connect_nodes(a, b)
+
+    def _chain_dirs(self):
+        # Nodes may not have been added yet when a cached state is restored
+        datadirs = [get_datadir_path(self.options.tmpdir, i) for i in range(self.num_nodes)]
+        return [os.path.join(datadir, get_chain_folder(datadir, self.chain)) for datadir in datadirs]
+
+    def _outbound_connections(self):
+        """Return the sorted (from, to) node pairs of the outbound connections between nodes.
+
+        Connections that masternodes opened to each other by themselves are left out."""
+        node_by_port = {p2p_port(node.index): i for i, node in enumerate(self.nodes)}
+        connections = []
+        for i, node in enumerate(self.nodes):
+            for peer in node.getpeerinfo():
+                port = int(peer['addr'].rsplit(':', 1)[1])
+                if not peer['inbound'] and not peer.get('masternode') and port in node_by_port:
+                    connections.append([i, node_by_port[port]])
+        return sorted(connections)
 
     def restart_node(self, i, extra_args=None, expected_stderr=''):
         """Stop and start a test node"""
@@ -749,14 +861,14 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         """
         rpc_connections = nodes or self.nodes
         timeout = int(timeout * self.options.timeout_factor)
-        stop_time = time.time() + timeout
-        while time.time() <= stop_time:
-            best_hash = [x.getbestblockhash() for x in rpc_connections]
-            if best_hash.count(best_hash[0]) == len(rpc_connections):
-                return
-            # Check that each peer has at least one connection
-            assert (all([len(x.getpeerinfo()) for x in rpc_connections]))
-            time.sleep(wait)
+        best_hash = []
+
+        def synced():
+            best_hash[:] = self.for_each_node(lambda node: node.getbestblockhash(), rpc_connections)
+            return best_hash.count(best_hash[0]) == len(rpc_connections)
+
+        if self.wait_for_sync(synced, rpc_connections, wait, timeout):
+            return
         raise AssertionError("Block sync timed out after {}s:{}".format(
             timeout,
             "".join("\n  {!r}".format(b) for b in best_hash),
@@ -766,30 +878,60 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         """
         Wait until everybody has the same transactions in their memory
         pools
+
+        The sizes of the mempools are compared first, their full contents
+        only once the sizes match.
         """
         rpc_connections = nodes or self.nodes
         timeout = int(timeout * self.options.timeout_factor)
-        stop_time = time.time() + timeout
         if self.mocktime != 0 and wait_func is None:
             wait_func = lambda: self.bump_mocktime(3, nodes=nodes)
-        while time.time() <= stop_time:
-            pool = [set(r.getrawmempool()) for r in rpc_connections]
-            if pool.count(pool[0]) == len(rpc_connections):
-                if flush_scheduler:
-                    for r in rpc_connections:
-                        if r.version_is_at_least(170000):
-                            r.syncwithvalidationinterfacequeue()
-                return
-            # Check that each peer has at least one connection
-            assert (all([len(x.getpeerinfo()) for x in rpc_connections]))
-            if wait_func is not None:
-                wait_func()
-            time.sleep(wait)
+
+        def synced():
+            sizes = [(info['size'], info['bytes']) for info in self.for_each_node(lambda node: node.getmempoolinfo(), rpc_connections)]
+            if sizes.count(sizes[0]) != len(rpc_connections):
+                return False
+            if sizes[0][0] == 0:
+                return True
+            pool = self.for_each_node(lambda node: set(node.getrawmempool()), rpc_connections)
+            return pool.count(pool[0]) == len(rpc_connections)
+
+        if self.wait_for_sync(synced, rpc_connections, wait, timeout, wait_func):
+            if flush_scheduler:
+                self.for_each_node(lambda node: node.syncwithvalidationinterfacequeue() if node.version_is_at_least(170000) else None,
+                                   rpc_connections)
+            return
+        pool = self.for_each_node(lambda node: set(node.getrawmempool()), rpc_connections)
         raise AssertionError("Mempool sync timed out after {}s:{}".format(
             timeout,
             "".join("\n  {!r}".format(m) for m in pool),
         ))
 
+    def wait_for_sync(self, synced, nodes, wait, timeout, wait_func=None):
+        """Call synced() until it returns True or timeout seconds have passed.
+
+        synced() is polled every 10ms at first, backing off to every
+        min(wait, 0.1) seconds. Every wait seconds while nodes aren't synced,
+        wait_func is called, if given, and each of the nodes is checked to
+        have at least one connection.
+
+        Returns whether synced() returned True."""
+        stop_time = time.time() + timeout
+        next_wait = time.time()
+        poll = 0.01
+        while time.time() <= stop_time:
+            if synced():
+                return True
+            if time.time() >= next_wait:
+                # Check that each peer has at least one connection
+                assert all(self.for_each_node(lambda node: node.getconnectioncount(), nodes))
+                if wait_func is not None:
+                    wait_func()
+                next_wait = time.time() + wait
+            time.sleep(poll)
+            poll = min(poll * 2, wait, 0.1)
+        return False
+
     def sync_all(self, nodes=None):
         self.sync_blocks(nodes)
         self.sync_mempools(nodes)
@@ -921,7 +1063,7 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         for i in range(self.num_nodes):
             self.log.debug("Copy cache directory {} to node {}".format(cache_node_dir, i))
             to_dir = get_datadir_path(self.options.tmpdir, i)
-            shutil.copytree(cache_node_dir, to_dir)
+            clone_tree(cache_node_dir, to_dir)
             initialize_datadir(self.options.tmpdir, i, self.chain)  # Overwrite port/rpcport in dash.conf
 
     def _initialize_chain_clean(self):
@@ -1025,6 +1167,16 @@ class MasternodeInfo:
         self.addr = addr
         self.evo = evo
 
+    def to_json(self):
+        """Return the fields of the masternode, without its node, for cached states."""
+        return {k: v for k, v in vars(self).items() if k != 'node'}
+
+    @classmethod
+    def from_json(cls, fields):
+        mninfo = cls.__new__(cls)
+        vars(mninfo).update(fields)
+        return mninfo
+
 
 class DashTestFramework(BitcoinTestFramework):
     def set_test_params(self):
@@ -1068,12 +1220,23 @@ class DashTestFramework(BitcoinTestFramework):
         # This is EXPIRATION_TIMEOUT + EXPIRATION_BIAS in CQuorumDataRequest
         self.quorum_data_request_expiration_timeout = 360
 
+        # Tests opt into restoring setup_network() and the activate_*() methods
+        # from cached states by setting this, see cached_step()
+        self.use_cached_states = False
+        # The steps since setup_network() that have been cached
+        self.cached_steps = None
+        self.cached_fingerprint = None
+        self.in_cached_step = False
+
     def set_dash_dip8_activation(self, activate_after_block):
         self.dip8_activation_height = activate_after_block
         for i in range(0, self.num_nodes):
             self.extra_args[i].append("-dip8params=%d" % (activate_after_block))
 
     def activate_dip8(self, slow_mode=False):
+        self.cached_step(self._activate_dip8, 'activate_dip8', slow_mode)
+
+    def _activate_dip8(self, slow_mode):
         # NOTE: set slow_mode=True if you are activating dip8 after a huge reorg
         # or nodes might fail to catch up otherwise due to a large
         # (MAX_BLOCKS_IN_TRANSIT_PER_PEER = 16 blocks) reorg error.
@@ -1086,6 +1249,9 @@ class DashTestFramework(BitcoinTestFramework):
         self.sync_blocks()
 
     def activate_by_name(self, name, expected_activation_height=None):
+        self.cached_step(self._activate_by_name, 'activate_by_name', name, expected_activation_height)
+
+    def _activate_by_name(self, name, expected_activation_height):
         assert not softfork_active(self.nodes[0], name)
         self.log.info("Wait for " + name + " activation")
 
@@ -1140,6 +1306,9 @@ class DashTestFramework(BitcoinTestFramework):
         self.activate_by_name('v20', expected_activation_height)
 
     def activate_ehf_by_name(self, name, expected_activation_height=None):
+        self.cached_step(self._activate_ehf_by_name, 'activate_ehf_by_name', name, expected_activation_height)
+
+    def _activate_ehf_by_name(self, name, expected_activation_height):
         self.nodes[0].sporkupdate("SPORK_24_TEST_EHF", 0)
         self.wait_for_sporks_same()
         assert get_bip9_details(self.nodes[0], name)['ehf']
@@ -1377,34 +1546,21 @@ class DashTestFramework(BitcoinTestFramework):
         start_idx = len(self.nodes)
 
         self.add_nodes(self.mn_count)
-        executor = ThreadPoolExecutor(max_workers=20)
-
-        def do_connect(idx):
-            # Connect to the control node only, masternodes should take care of intra-quorum connections themselves
-            self.connect_nodes(self.mninfo[idx].nodeIdx, 0)
-
-        jobs = []
+        masternodes = self.mninfo[:self.mn_count]
+        for idx, mninfo in enumerate(masternodes):
+            mninfo.nodeIdx = idx + start_idx
+        start = time.time()
 
         # start up nodes in parallel
-        for idx in range(0, self.mn_count):
-            self.mninfo[idx].nodeIdx = idx + start_idx
-            jobs.append(executor.submit(self.start_masternode, self.mninfo[idx]))
-
-        # wait for all nodes to start up
-        for job in jobs:
-            job.result()
-        jobs.clear()
+        self.for_each_node(self.start_masternode, masternodes)
+        if masternodes:
+            slowest = max(masternodes, key=lambda mninfo: mninfo.node.startup_latency)
+            self.log.debug("Started %d masternodes in %.2fs, slowest was node %d after %.2fs" %
+                           (self.mn_count, time.time() - start, slowest.nodeIdx, slowest.node.startup_latency))
 
         # connect nodes in parallel
-        for idx in range(0, self.mn_count):
-            jobs.append(executor.submit(do_connect, idx))
-
-        # wait for all nodes to connect
-        for job in jobs:
-            job.result()
-        jobs.clear()
-
-        executor.shutdown()
+        # Connect to the control node only, masternodes should take care of intra-quorum connections themselves
+        self.for_each_node(lambda mninfo: self.connect_nodes(mninfo.nodeIdx, 0), masternodes)
 
     def start_masternode(self, mninfo, extra_args=None):
         args = ['-masternodeblsprivkey=%s' % mninfo.keyOperator] + self.extra_args[mninfo.nodeIdx]
@@ -1450,6 +1606,10 @@ class DashTestFramework(BitcoinTestFramework):
         self.prepare_datadirs()
 
     def setup_network(self):
+        self.cached_steps = []
+        self.cached_step(self._setup_network, 'setup_network')
+
+    def _setup_network(self):
         self.setup_nodes()
 
         # non-masternodes where disconnected from the control node during prepare_datadirs,
@@ -1479,6 +1639,95 @@ class DashTestFramework(BitcoinTestFramework):
         for status in mn_info.values():
             assert status == 'ENABLED'
 
+    def cached_step(self, build, *step):
+        """Call build(*step[1:]), or restore the state it leads to from the cache.
+
+        setup_network() and the activate_*() methods are cached steps in tests
+        that set use_cached_states, so the chain, the wallets and self.mninfo
+        after setting up the masternodes and mining hundreds of blocks to
+        activate forks are only built once. Snapshots survive test_runner.py
+        runs until dashd is rebuilt.
+
+        Every cached step restarts all nodes, whether it was built or
+        restored, so state that dashd only keeps in memory is lost: LLMQ
+        connections, DKG sessions, recovered signatures, and the mempool with
+        -persistmempool=0. Only tests that don't depend on it should opt in.
+
+        A cached state is identified by all the steps that led to it, so it
+        can only be used as long as the test hasn't done anything else in
+        between. The tips, mempool sizes, wallets and their transaction
+        counts of all nodes, the sporks, the mocktime, the connections
+        between nodes, P2P peers and the args nodes were started with are
+        checked for that. Past the first change, steps are run as usual.
+        Changes that don't show up in those, such as keys imported into a
+        wallet, are not noticed."""
+        if self.in_cached_step:
+            # A step that is part of another one
+            return build(*step[1:])
+        if not self.use_cached_states:
+            self.cached_steps = None
+        elif self.cached_steps:
+            fingerprint = self._state_fingerprint()
+            if fingerprint is None or fingerprint != self.cached_fingerprint:
+                self.cached_steps = None
+        if self.cached_steps is None:
+            return build(*step[1:])
+
+        def build_state():
+            build(*step[1:])
+            return [mninfo.to_json() for mninfo in self.mninfo]
+
+        steps = self.cached_steps + [list(step)]
+        self.in_cached_step = True
+        try:
+            self.cached_state(' '.join(str(s) for s in step), build_state, key=steps)
+        finally:
+            self.in_cached_step = False
+        self.cached_steps = steps
+        self.cached_fingerprint = self._state_fingerprint()
+
+    def _state_fingerprint(self):
+        """Return what changes when the test does something to the nodes, or None if a node is stopped."""
+        if not all(node.running for node in self.nodes):
+            return None
+
+        def node_fingerprint(node):
+            wallets = node.listwallets()
+            return [node.start_args, node.getbestblockhash(), node.getmempoolinfo()['size'], wallets,
+                    [node.get_wallet_rpc(w).getwalletinfo()['txcount'] for w in wallets]]
+
+        return [self.for_each_node(node_fingerprint), any(node.p2ps for node in self.nodes), self.mocktime,
+                self.nodes[0].spork('show'), self._outbound_connections()]
+
+    def cached_state_key(self):
+        # Arguments may contain paths into the tmpdir of the test, which differs between runs.
+        # Overridden setup methods build a different state.
+        extra_args = [[arg.replace(self.options.tmpdir, '<tmpdir>') for arg in args] for args in self.extra_args]
+        methods = [getattr(type(self), m).__qualname__ for m in
+                   ('setup_nodes', 'prepare_masternodes', 'prepare_masternode', 'start_masternodes', 'start_masternode')]
+        return [self.num_nodes, self.mn_count, self.evo_count, extra_args, methods]
+
+    def start_cached_nodes(self, metadata):
+        if [mninfo.proTxHash for mninfo in self.mninfo] != [mninfo['proTxHash'] for mninfo in metadata['result']]:
+            self.mninfo = [MasternodeInfo.from_json(mninfo) for mninfo in metadata['result']]
+
+        # The nodes of a restored setup_network() state haven't been added yet
+        num_simple_nodes = self.num_nodes - self.mn_count
+        for i in range(len(self.nodes), num_simple_nodes):
+            self.add_nodes(1, extra_args=[self.extra_args[i]])
+        if len(self.nodes) < self.num_nodes:
+            self.add_nodes(self.mn_count)
+
+        simple_nodes = self.nodes[:num_simple_nodes]
+        for node in simple_nodes:
+            node.start()
+        self.for_each_node(self.start_masternode, self.mninfo[:self.mn_count])
+        self.wait_for_rpc_connections(simple_nodes)
+        for node in simple_nodes:
+            force_finish_mnsync(node)
+        for a, b in metadata['connections']:
+            self.connect_nodes(a, b)
+
     def create_raw_tx(self, node_from, node_to, amount, min_inputs, max_inputs):
 
         # helper which has been supposed to be removed with bitcoin#20159 but we use it
@@ -2078,3 +2327,58 @@ class DashTestFramework(BitcoinTestFramework):
                     c += 1
             return c >= count
         wait_until(test, timeout=timeout)
+
+
+class TestFrameworkDash(unittest.TestCase):
+    def test_masternode_info_json(self):
+        mninfo = MasternodeInfo('00' * 32, 'owner', 'voting', 'rewards', 1, 'pubkey', 'secret', 'collateral', '11' * 32, 1,
+                                '127.0.0.1:12345', True)
+        mninfo.nodeIdx = 3
+        mninfo.node = object()
+        fields = mninfo.to_json()
+        self.assertNotIn('node', fields)
+
+        restored = MasternodeInfo.from_json(json.loads(json.dumps(fields)))
+        self.assertEqual(restored.nodeIdx, 3)
+        self.assertEqual(restored.keyOperator, 'secret')
+        self.assertTrue(restored.evo)
+        self.assertFalse(hasattr(restored, 'node'))
+        self.assertEqual(restored.to_json(), fields)
+
+    def test_cached_state_key(self):
+        class KeyTest(DashTestFramework):
+            def set_test_params(self):
+                pass
+
+            def run_test(self):
+                pass
+
+        class SetupKeyTest(KeyTest):
+            set_test_params = KeyTest.set_test_params
+            run_test = KeyTest.run_test
+
+            def setup_nodes(self):
+                pass
+
+        def key(tmpdir, test_class=KeyTest, extra_args=("-txindex",)):
+            test = test_class.__new__(test_class)
+            test.options = argparse.Namespace(tmpdir=tmpdir)
+            test.set_dash_test_params(3, 2, extra_args=[["-walletnotify=%s/notify %%s" % tmpdir, *extra_args]] * 3)
+            return json.dumps(test.cached_state_key())
+
+        self.assertEqual(key("/tmp/test_runner_1/feature_a"), key("/tmp/test_runner_2/feature_a"))
+        self.assertNotIn("/tmp/test_runner_1", key("/tmp/test_runner_1/feature_a"))
+        self.assertNotEqual(key("/tmp/a"), key("/tmp/a", extra_args=()))
+        self.assertNotEqual(key("/tmp/a"), key("/tmp/a", SetupKeyTest))
+
+    def test_for_each_node_nested(self):
+        test = DashTestFramework.__new__(DashTestFramework)
+        test.node_executor = None
+        nodes = list(range(MAX_NODES))
+        try:
+            # Every pool thread waits on a nested call, which must not queue behind them
+            result = test.for_each_node(lambda i: test.for_each_node(lambda j: i * j, nodes), nodes)
+        finally:
+            test.node_executor.shutdown()
+        self.assertEqual(result, [[i * j for j in nodes] for i in nodes])
+        self.assertFalse(getattr(_node_thread, 'active', False))
@@ -23,6 +23,7 @@ import collections
 
 from .authproxy import JSONRPCException
 from .messages import MY_SUBVERSION
+from .swarm import PeerSwarm
 from .util import (
     MAX_NODES,
     append_config,
@@ -43,6 +44,49 @@ class FailedToStartError(Exception):
     """Raised when a node fails to start correctly."""
 
 
+class DebugLogWatcher:
+    """Follows a node's debug.log from an offset, waiting for a line to appear.
+
+    The path is looked up on every poll, because the chain directory is only
+    created once the node starts."""
+
+    def __init__(self, get_path, offset, marker, process):
+        self.get_path = get_path
+        self.offset = offset
+        self.marker = marker
+        self.process = process
+        self.found = False
+        self._tail = b""
+
+    def _poll(self):
+        try:
+            with open(self.get_path(), 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        if not data:
+            return False
+        self.offset += len(data)
+        # Keep the end of what was read, in case the marker is split across reads
+        data = self._tail + data
+        self.found = self.marker in data
+        self._tail = data[-len(self.marker):]
+        return True
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for the marker, or for the process to exit.
+
+        Returns whether the marker was found."""
+        time_end = time.time() + timeout
+        while not self.found and self.process.poll() is None:
+            if not self._poll():
+                time.sleep(0.005)
+            if time.time() >= time_end:
+                break
+        return self.found
+
+
 class ErrorMatch(Enum):
     FULL_TEXT = 1
     FULL_REGEX = 2
@@ -125,6 +169,14 @@ class TestNode():
 
         self.running = False
         self.process = None
+        # The extra_args the node was last started with
+        self.start_args = None
+        self.debug_log_path = None
+        self.debug_log_offset = 0
+        # Time at which the process was last started, and how long it then
+        # took until RPC was up
+        self.start_time = None
+        self.startup_latency = None
         self.rpc_connected = False
         self.rpc = None
         self.url = None
@@ -196,6 +248,7 @@ class TestNode():
         """Start the node."""
         if extra_args is None:
             extra_args = self.extra_args
+        self.start_args = list(extra_args)
 
         # Add a new stdout and stderr file each time dashd is started
         if stderr is None:
@@ -220,6 +273,17 @@ class TestNode():
         # add environment variable LIBC_FATAL_STDERR_=1 so that libc errors are written to stderr and not the terminal
         subp_env = dict(os.environ, LIBC_FATAL_STDERR_="1")
 
+        # Remember where the log of this run starts, to see when it is ready
+        self.debug_log_path = self._debug_log_path(all_args)
+        self.debug_log_offset = 0
+        if self.debug_log_path is not None:
+            try:
+                self.debug_log_offset = os.path.getsize(self.debug_log_path())
+            except OSError:
+                pass
+
+        self.start_time = time.time()
+        self.startup_latency = None
         self.process = subprocess.Popen(all_args, env=subp_env, stdout=stdout, stderr=stderr, cwd=cwd, **kwargs)
 
         self.running = True
@@ -228,11 +292,35 @@ class TestNode():
         if self.start_perf:
             self._start_perf()
 
+    def _debug_log_path(self, args):
+        """Return a function returning the path of the debug log the node writes with args, or None if it writes none."""
+        datadir = self.datadir
+        log_file = 'debug.log'
+        for arg in args:
+            if arg.startswith('-datadir='):
+                datadir = arg[len('-datadir='):]
+            elif arg.startswith('-nodebuglogfile') or arg == '-debuglogfile=0':
+                return None
+            elif arg.startswith('-debuglogfile='):
+                log_file = arg[len('-debuglogfile='):]
+        return lambda: os.path.join(datadir, get_chain_folder(datadir, self.chain), log_file)
+
     def wait_for_rpc_connection(self):
-        """Sets up an RPC connection to the dashd process. Returns False if unable to connect."""
-        # Poll at a rate of four times per second
-        poll_per_s = 4
-        for _ in range(poll_per_s * self.rpc_timeout):
+        """Sets up an RPC connection to the dashd process. Returns False if unable to connect.
+
+        Rather than polling RPC while the node starts, this waits for the node
+        to log that it is done loading, and only then connects. In case it
+        logs somewhere else than expected, RPC is still tried every second."""
+        # Poll with an exponential backoff, from 10ms up to four times per second
+        delay = 0.01
+        max_delay = 0.25
+        time_end = time.time() + self.rpc_timeout
+        ready = None
+        if self.debug_log_path is not None:
+            ready = DebugLogWatcher(self.debug_log_path, self.debug_log_offset, b"init message: Done loading", self.process)
+        while time.time() < time_end:
+            if ready is not None and not ready.found:
+                ready.wait(min(1.0, max(0, time_end - time.time())))
             if self.process.poll() is not None:
                 raise FailedToStartError(self._node_msg(
                     'dashd exited with status {} during initialization'.format(self.process.returncode)))
@@ -266,7 +354,8 @@ class TestNode():
                     # as possible. Some tests might not need this, but the
                     # overhead is trivial, and the added guarantees are worth
                     # the minimal performance cost.
-                self.log.debug("RPC successfully started")
+                self.startup_latency = time.time() - self.start_time
+                self.log.debug("RPC successfully started after %.2fs" % self.startup_latency)
                 if self.use_cli:
                     return
                 self.rpc = rpc
@@ -292,7 +381,9 @@ class TestNode():
             except ValueError as e:  # cookie file not found and no rpcuser or rpcpassword; dashd is still starting
                 if "No RPC credentials" not in str(e):
                     raise
-            time.sleep(1.0 / poll_per_s)
+            if ready is None or ready.found:
+                time.sleep(delay)
+                delay = min(delay * 2, max_delay)
         self._raise_assertion_error("Unable to connect to dashd after {}s".format(self.rpc_timeout))
 
     def wait_for_cookie_credentials(self):
@@ -379,7 +470,14 @@ class TestNode():
         return True
 
     def wait_until_stopped(self, timeout=BITCOIND_PROC_WAIT_TIMEOUT):
-        wait_until(self.is_node_stopped, timeout=timeout, timeout_factor=self.timeout_factor)
+        if self.running:
+            # Block on the process instead of polling it, so that the exit is
+            # noticed right away
+            try:
+                self.process.wait(timeout * self.timeout_factor)
+            except subprocess.TimeoutExpired:
+                pass
+        wait_until(self.is_node_stopped, attempts=1, timeout_factor=self.timeout_factor)
 
     @contextlib.contextmanager
     def assert_debug_log(self, expected_msgs, unexpected_msgs=None, timeout=2):
@@ -563,6 +661,15 @@ class TestNode():
 
         return p2p_conn
 
+    def add_p2p_swarm(self, num_peers, *, wait_for_handshake=True, **kwargs):
+        """Open num_peers lightweight p2p connections to the node at once.
+
+        The peers are added to the self.p2ps list. Returns the PeerSwarm, see
+        test_framework.swarm."""
+        swarm = PeerSwarm(self, num_peers)
+        swarm.connect(wait_for_handshake=wait_for_handshake, **kwargs)
+        return swarm
+
     def num_test_p2p_connections(self):
         """Return number of test framework p2p connections to the node."""
         return len([peer for peer in self.getpeerinfo() if peer['subver'] == MY_SUBVERSION.decode("utf-8")])
@@ -13,12 +13,13 @@ import inspect
 import json
 import logging
 import os
-import shutil
 import re
+import threading
 import time
 
 from . import coverage
 from .authproxy import AuthServiceProxy, JSONRPCException
+from .snapshot import clone_tree
 from io import BytesIO
 
 logger = logging.getLogger("TestFramework.utils")
@@ -234,15 +235,30 @@ def wait_until(predicate, *, attempts=float('inf'), timeout=float('inf'), sleep=
     from `BitcoinTestFramework` or `P2PInterface` class ensures an understandable
     amount of timeout and a common shared timeout_factor. Furthermore, `wait_until()`
     from `P2PInterface` class in `mininode.py` has a preset lock.
+
+    If lock is a threading.Condition, waiting between attempts ends early as
+    soon as the condition is notified, so the predicate is checked again as
+    soon as the state it depends on may have changed. Such wakeups don't count
+    as attempts, only each full sleep does.
     """
     if attempts == float('inf') and timeout == float('inf'):
         timeout = 60
     timeout = timeout * timeout_factor
     attempt = 0
     time_end = time.time() + timeout
+    attempt_end = time.time() + sleep
 
     while attempt < attempts and time.time() < time_end:
         try:
+            if isinstance(lock, threading.Condition):
+                with lock:
+                    if predicate():
+                        return True
+                    lock.wait(max(0, min(attempt_end, time_end) - time.time()))
+                if time.time() >= attempt_end:
+                    attempt += 1
+                    attempt_end = time.time() + sleep
+                continue
             if lock:
                 with lock:
                     if predicate():
@@ -426,7 +442,7 @@ def copy_datadir(from_node, to_node, dirname, chain):
         try:
             src = os.path.join(from_datadir, d)
             dst = os.path.join(to_datadir, d)
-            shutil.copytree(src, dst)
+            clone_tree(src, dst)
         except:
             pass
 
@@ -27,6 +27,8 @@ import re
 import logging
 import unittest
 
+from test_framework.snapshot import flush_cache
+
 # Formatting. Default colors to empty strings.
 DEFAULT, BOLD, GREEN, RED = ("", ""), ("", ""), ("", ""), ("", "")
 try:
@@ -73,10 +75,17 @@ TEST_FRAMEWORK_MODULES = [
     "address",
     "blocktools",
     "ellswift",
+    "framing",
     "key",
+    "messages",
     "muhash",
+    "p2p",
     "ripemd160",
     "script",
+    "serialize",
+    "snapshot",
+    "swarm",
+    "test_framework",
 ]
 
 EXTENDED_SCRIPTS = [
@@ -84,6 +93,7 @@ EXTENDED_SCRIPTS = [
     # Longest test should go first, to favor running tests in parallel
     'feature_pruning.py', # NOTE: Prune mode is incompatible with -txindex, should work with governance validation disabled though.
     'feature_dbcrash.py',
+    'p2p_swarm.py',
 ]
 
 BASE_SCRIPTS = [
@@ -126,6 +136,8 @@ BASE_SCRIPTS = [
     'feature_dip4_coinbasemerkleroots.py', # NOTE: needs dash_hash to pass
     'feature_asset_locks.py', # NOTE: needs dash_hash to pass
     'feature_mnehf.py', # NOTE: needs dash_hash to pass
+    'feature_cached_states.py', # NOTE: needs dash_hash to pass
+    'feature_cached_states.py --cached', # NOTE: needs dash_hash to pass
     # vv Tests less than 60s vv
     'p2p_sendheaders.py', # NOTE: needs dash_hash to pass
     'p2p_sendheaders_compressed.py', # NOTE: needs dash_hash to pass
@@ -298,6 +310,7 @@ ALL_SCRIPTS = EXTENDED_SCRIPTS + BASE_SCRIPTS
 
 NON_SCRIPTS = [
     # These are python files that live in the functional tests directory, but are not test scripts.
+    "bench_framework.py",
     "combine_logs.py",
     "create_cache.py",
     "test_runner.py",
@@ -422,7 +435,9 @@ def main():
     check_script_prefixes()
 
     if not args.keepcache:
-        shutil.rmtree("%s/test/cache" % config["environment"]["BUILDDIR"], ignore_errors=True)
+        # Snapshots of cached states are kept until dashd is rebuilt
+        dashd = os.getenv("BITCOIND", default=os.path.join(config["environment"]["BUILDDIR"], "src", "dashd" + config["environment"]["EXEEXT"]))
+        flush_cache("%s/test/cache" % config["environment"]["BUILDDIR"], dashd)
 
     run_tests(
         test_list=test_list,